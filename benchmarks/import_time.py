@@ -0,0 +1,64 @@
+"""
+Measure the import time of kohaku_nai modules.
+
+Every module is imported in a fresh interpreter with `-X importtime`, the
+cumulative time of the module and its slowest dependencies are reported.
+
+    python -m benchmarks.import_time
+    python -m benchmarks.import_time kohaku_nai.server --runs 10 --top 15
+"""
+
+import argparse
+import statistics
+import subprocess
+import sys
+
+
+DEFAULT_MODULES = ["kohaku_nai.api", "kohaku_nai.utils", "kohaku_nai.server"]
+
+
+def import_times(module: str) -> dict[str, int]:
+    """Cumulative import time in microseconds of every module loaded."""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line.split("|")
+        times[name.strip()] = int(cumulative)
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("modules", nargs="*", default=DEFAULT_MODULES)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=10)
+    args = parser.parse_args()
+
+    # Modules loaded at interpreter startup are not our cost
+    startup = set(import_times("sys"))
+    for module in args.modules:
+        runs = [import_times(module) for _ in range(args.runs)]
+        total = statistics.median(run[module] for run in runs) / 1000
+        print(f"{module}: {total:.1f} ms (median of {args.runs})")
+        # Top level packages only, submodules are part of their package
+        slowest = sorted(
+            (
+                (statistics.median(run.get(name, 0) for run in runs), name)
+                for name in runs[-1]
+                if name != module and "." not in name and name not in startup
+            ),
+            reverse=True,
+        )
+        for cumulative, name in slowest[: args.top]:
+            print(f"    {name:<30} {cumulative / 1000:8.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+"""
+Compare token selection strategies on simulated tokens.
+
+Every token has its own latency (lognormal around `mean`) and error rate, one
+of them is degraded. Requests arrive as a Poisson process and go through the
+real TokenScheduler, latency is the time from arrival to a successful response
+(queue wait + upstream + retries).
+
+    python -m benchmarks.token_selection --requests 2000 --load 0.6
+"""
+
+import argparse
+import asyncio
+import random
+import time
+
+from kohaku_nai.server_modules.breaker import CircuitBreaker
+from kohaku_nai.server_modules.ratelimit import TokenBucket
+from kohaku_nai.server_modules.scheduler import TokenScheduler
+from kohaku_nai.server_modules.selection import STRATEGIES, TokenStats
+
+
+# (mean latency, error rate) of each simulated token, the first one is degraded
+TOKENS = [(3.0, 0.15), (1.0, 0.01), (1.3, 0.02), (1.0, 0.01)]
+
+
+class FakeToken:
+    def __init__(self, mean: float, error_rate: float):
+        self.mean = mean
+        self.error_rate = error_rate
+        self.breaker = CircuitBreaker(0.0, 0.0, failure_threshold=1000)
+        self.bucket = TokenBucket(0)
+        self.stats = TokenStats()
+        self.leased = False
+        self.served = 0
+
+
+async def run_strategy(
+    name: str, requests: int, load: float, scale: float, seed: int
+) -> tuple[list[float], list[int]]:
+    rng = random.Random(seed)
+    random.seed(seed)
+    tokens = [FakeToken(mean, error_rate) for mean, error_rate in TOKENS]
+    scheduler = TokenScheduler(select=STRATEGIES[name])
+    for token in tokens:
+        scheduler.add_client(token)
+    capacity = sum(1 / mean for mean, _ in TOKENS)
+    latencies: list[float] = []
+
+    async def request():
+        start = time.perf_counter()
+        while True:
+            token = await scheduler.acquire()
+            latency = token.mean * rng.lognormvariate(0, 0.3)
+            success = rng.random() >= token.error_rate
+            await asyncio.sleep(latency * scale)
+            token.stats.record(latency, success)
+            token.served += success
+            scheduler.release(token)
+            if success:
+                break
+        latencies.append((time.perf_counter() - start) / scale)
+
+    tasks = []
+    for _ in range(requests):
+        tasks.append(asyncio.create_task(request()))
+        await asyncio.sleep(rng.expovariate(capacity * load) * scale)
+    await asyncio.gather(*tasks)
+    return latencies, [token.served for token in tokens]
+
+
+def percentile(values: list[float], q: float) -> float:
+    values = sorted(values)
+    return values[min(int(q * len(values)), len(values) - 1)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--load", type=float, default=0.6, help="fraction of capacity")
+    parser.add_argument("--scale", type=float, default=0.005, help="seconds per unit")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    print(f"tokens (mean latency, error rate): {TOKENS}, load {args.load}")
+    print(f"{'strategy':<8} {'p50':>6} {'p95':>6} {'p99':>6}  served per token")
+    for name in STRATEGIES:
+        latencies, served = asyncio.run(
+            run_strategy(name, args.requests, args.load, args.scale, args.seed)
+        )
+        print(
+            f"{name:<8} {percentile(latencies, 0.5):6.2f} "
+            f"{percentile(latencies, 0.95):6.2f} {percentile(latencies, 0.99):6.2f}"
+            f"  {served}"
+        )
+
+
+if __name__ == "__main__":
+    main()
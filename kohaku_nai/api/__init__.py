@@ -1,10 +1,11 @@
 import sys
 import asyncio
-from httpx import AsyncClient
-from curl_cffi.requests import AsyncSession
 
 from .image import (
     generate_novelai_image,
+    generate_novelai_images,
+    make_payload,
+    HttpClient,
     DEFAULT_ARGS,
     QUALITY_TAGS,
     UCPRESET,
@@ -18,12 +19,17 @@ if sys.platform == "win32":
 
 API_URL = "https://api.novelai.net"
 API_IMAGE_URL = "https://image.novelai.net"
-HttpClient = AsyncClient | AsyncSession
 
 jwt_token = ""
 global_client: HttpClient | None = None
 
 
+async def close_client(client: HttpClient):
+    # httpx uses aclose, curl_cffi uses close
+    close = getattr(client, "aclose", None) or client.close
+    await close()
+
+
 async def make_client(
     backend: str = "httpx",
     remote_server: str = "",
@@ -32,17 +38,14 @@ async def make_client(
 ):
     assert backend in ["httpx", "curl_cffi"]
     assert remote_server or token
+    # Only import the backend in use, both are slow to import
     if backend == "httpx":
-        client_class = AsyncClient
+        from httpx import AsyncClient as client_class
     else:
-        client_class = AsyncSession
+        from curl_cffi.requests import AsyncSession as client_class
 
     if remote_server:
         client = client_class(timeout=3600)
-        payload = {"password": password}
-        response = await client.post(f"{remote_server}/login", params=payload)
-        if response.status_code == 200:
-            return client, response.json()["status"]
     else:
         kwargs = {
             "timeout": 3600,
@@ -53,9 +56,21 @@ async def make_client(
         if backend == "curl_cffi":
             kwargs["impersonate"] = "chrome110"
         client = client_class(**kwargs)
-        status = await client.get(f"{API_URL}/user/data")
-        if status.status_code == 200:
-            return client, status.json()
+    # Close the client unless it is handed out, also on errors and timeouts
+    try:
+        if remote_server:
+            payload = {"password": password}
+            response = await client.post(f"{remote_server}/login", params=payload)
+            if response.status_code == 200:
+                return client, response.json()["status"]
+        else:
+            status = await client.get(f"{API_URL}/user/data")
+            if status.status_code == 200:
+                return client, status.json()
+    except BaseException:
+        await close_client(client)
+        raise
+    await close_client(client)
     return None, None
 
 
@@ -72,6 +87,8 @@ async def set_client(
 
 __all__ = [
     "generate_novelai_image",
+    "generate_novelai_images",
+    "make_payload",
     "API_URL",
     "API_IMAGE_URL",
     "HttpClient",
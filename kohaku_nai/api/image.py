@@ -1,14 +1,22 @@
 import random
-import io
-import zipfile
 import json
-from httpx import AsyncClient
-from curl_cffi.requests import AsyncSession
+from typing import TYPE_CHECKING, Any
 from .. import api
+from .unzip import extract_zip
+
+if TYPE_CHECKING:
+    from httpx import AsyncClient
+    from curl_cffi.requests import AsyncSession
+
+    HttpClient = AsyncClient | AsyncSession
+else:
+    # http backends are imported on demand, see make_client
+    HttpClient = Any
 
 
 API_IMAGE_URL = "https://image.novelai.net"
-HttpClient = AsyncClient | AsyncSession
+# Upper bound of a generate-image response (a zip of n_samples PNGs)
+MAX_RESPONSE_SIZE = 256 * 1024 * 1024
 
 
 QUALITY_TAGS = "best quality, amazing quality, very aesthetic, absurdres"
@@ -57,7 +65,7 @@ MODEL_LIST = [
 ]
 
 
-async def generate_novelai_image(
+def make_payload(
     prompt="",
     quality_tags=False,
     negative_prompt="",
@@ -74,13 +82,12 @@ async def generate_novelai_image(
     dyn_threshold=False,
     cfg_rescale=0,
     model="nai-diffusion-3",
-    client: HttpClient | None = None,
-    **kwargs,
+    n_samples=1,
 ):
-    if kwargs:
-        print(f"Unused kwargs: {kwargs.keys()}")
-    if client is None:
-        client = api.global_client
+    """
+    Build the payload of NAI's generate-image api.
+    The payload is fully deterministic unless seed is -1.
+    """
     # Assign a random seed if seed is -1
     if seed == -1:
         seed = random.randint(0, 2**32 - 1)
@@ -98,7 +105,7 @@ async def generate_novelai_image(
             "scale": scale,
             "sampler": sampler,
             "steps": steps,
-            "n_samples": 1,
+            "n_samples": n_samples,
             "ucPreset": 0,
             "add_original_image": False,
             "cfg_rescale": cfg_rescale,
@@ -144,21 +151,186 @@ async def generate_novelai_image(
             "use_coords": False,
             "use_order": False,
         }
+    return payload
+
+
+class BufferedResponse:
+    """
+    A streamed response whose body is already read. Provides the attributes
+    callers use on failed responses: status_code, headers, text and json().
+    """
+
+    def __init__(self, status_code: int, headers: Any, content: bytes):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+    @property
+    def text(self) -> str:
+        return self.content.decode("utf-8", "replace")
+
+    def json(self) -> Any:
+        return json.loads(self.content)
+
+
+async def read_body(response: Any, max_size: int) -> bytearray | None:
+    """
+    Read a streamed response into one buffer, None if it exceeds `max_size`.
+    With a Content-Length the buffer is allocated once and every chunk is
+    copied into it exactly once.
+    """
+    # httpx and curl_cffi name their chunk iterators differently
+    iter_chunks = getattr(response, "aiter_bytes", None) or response.aiter_content
+    length = response.headers.get("Content-Length")
+    if length is not None and int(length) > max_size:
+        return None
+    if length is None or response.headers.get("Content-Encoding"):
+        # Unknown (decoded) size, grow as chunks arrive
+        buffer = bytearray()
+        async for chunk in iter_chunks():
+            buffer += chunk
+            if len(buffer) > max_size:
+                return None
+        return buffer
+
+    expected = int(length)
+    buffer = bytearray(expected)
+    view = memoryview(buffer)
+    received = 0
+    async for chunk in iter_chunks():
+        end = received + len(chunk)
+        if end > expected:
+            raise ValueError("Response is longer than its Content-Length")
+        view[received:end] = chunk
+        received = end
+    view.release()
+    del buffer[received:]
+    return buffer
+
+
+async def generate_novelai_images(
+    prompt="",
+    quality_tags=False,
+    negative_prompt="",
+    ucpreset="",
+    seed=-1,
+    scale=5.0,
+    width=1024,
+    height=1024,
+    steps=28,
+    sampler="k_euler",
+    schedule="native",
+    smea=False,
+    dyn=False,
+    dyn_threshold=False,
+    cfg_rescale=0,
+    model="nai-diffusion-3",
+    n_samples=1,
+    client: HttpClient | None = None,
+    dump_payload=True,
+    max_response_size=MAX_RESPONSE_SIZE,
+    **kwargs,
+):
+    """
+    Generate `n_samples` images in one request.
+    Return the list of images and the json payload on success,
+    or the error message and the response on failure.
+
+    With `dump_payload=False` the payload is returned as a dict, for callers
+    which only need the json sometimes. The response is streamed and
+    rejected once it exceeds `max_response_size` bytes.
+    """
+    if kwargs:
+        print(f"Unused kwargs: {kwargs.keys()}")
+    if client is None:
+        client = api.global_client
+    payload = make_payload(
+        prompt,
+        quality_tags,
+        negative_prompt,
+        ucpreset,
+        seed,
+        scale,
+        width,
+        height,
+        steps,
+        sampler,
+        schedule,
+        smea,
+        dyn,
+        dyn_threshold,
+        cfg_rescale,
+        model,
+        n_samples,
+    )
 
     # Send the POST request
-    response = await client.post(f"{API_IMAGE_URL}/ai/generate-image", json=payload)
+    async with client.stream(
+        "POST", f"{API_IMAGE_URL}/ai/generate-image", json=payload
+    ) as response:
+        body = await read_body(response, max_response_size)
+        status_code, headers = response.status_code, response.headers
+    if body is None:
+        return (
+            f"Response exceeds {max_response_size} bytes",
+            BufferedResponse(status_code, headers, b""),
+        )
 
     # Process the response
-    if response.headers.get("Content-Type") == "binary/octet-stream":
-        zipfile_in_memory = io.BytesIO(response.content)
-        with zipfile.ZipFile(zipfile_in_memory, "r") as zip_ref:
-            file_names = zip_ref.namelist()
-            if file_names:
-                with zip_ref.open(file_names[0]) as file:
-                    return file.read(), json.dumps(
-                        payload, ensure_ascii=False, indent=2
-                    )
-            else:
-                return "NAI doesn't return any images", response
+    if headers.get("Content-Type") == "binary/octet-stream":
+        images = extract_zip(body)
+        if images:
+            if dump_payload:
+                return images, json.dumps(payload, ensure_ascii=False, indent=2)
+            return images, payload
+        return "NAI doesn't return any images", BufferedResponse(
+            status_code, headers, b""
+        )
     else:
-        return "Generation failed", response
\ No newline at end of file
+        return "Generation failed", BufferedResponse(status_code, headers, bytes(body))
+
+
+async def generate_novelai_image(
+    prompt="",
+    quality_tags=False,
+    negative_prompt="",
+    ucpreset="",
+    seed=-1,
+    scale=5.0,
+    width=1024,
+    height=1024,
+    steps=28,
+    sampler="k_euler",
+    schedule="native",
+    smea=False,
+    dyn=False,
+    dyn_threshold=False,
+    cfg_rescale=0,
+    model="nai-diffusion-3",
+    client: HttpClient | None = None,
+    **kwargs,
+):
+    images, info = await generate_novelai_images(
+        prompt,
+        quality_tags,
+        negative_prompt,
+        ucpreset,
+        seed,
+        scale,
+        width,
+        height,
+        steps,
+        sampler,
+        schedule,
+        smea,
+        dyn,
+        dyn_threshold,
+        cfg_rescale,
+        model,
+        1,
+        client,
+        **kwargs,
+    )
+    if isinstance(images, list):
+        return images[0], info
+    return images, info
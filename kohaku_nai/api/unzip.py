@@ -0,0 +1,73 @@
+import io
+import struct
+import zipfile
+import zlib
+
+
+# signature, version, flags, method, time, date, crc32, compressed size,
+# size, name length, extra length
+LOCAL_HEADER = struct.Struct("<IHHHHHIIIHH")
+LOCAL_SIGNATURE = 0x04034B50
+# Records after the last entry
+END_SIGNATURES = (0x02014B50, 0x06054B50)
+STORED = 0
+DEFLATED = 8
+# encrypted, sizes in a data descriptor after the data
+UNSUPPORTED_FLAGS = 0x01 | 0x08
+
+
+def extract_zip(data: bytes | bytearray | memoryview) -> list[bytes]:
+    """
+    Contents of every entry of a zip archive, in archive order.
+
+    Local headers are parsed straight from the buffer: stored entries are
+    copied once out of it, deflated ones are inflated from a view of it.
+    Archives this doesn't handle (zip64, data descriptors, other compression)
+    go through zipfile.
+    """
+    view = memoryview(data)
+    entries = []
+    offset = 0
+    while offset + 4 <= len(view):
+        (signature,) = struct.unpack_from("<I", view, offset)
+        if signature in END_SIGNATURES:
+            break
+        if signature != LOCAL_SIGNATURE or offset + LOCAL_HEADER.size > len(view):
+            raise zipfile.BadZipFile("File is not a zip file")
+        (
+            _,
+            _,
+            flags,
+            method,
+            _,
+            _,
+            crc,
+            compressed_size,
+            size,
+            name_length,
+            extra_length,
+        ) = LOCAL_HEADER.unpack_from(view, offset)
+        if (
+            flags & UNSUPPORTED_FLAGS
+            or method not in (STORED, DEFLATED)
+            or 0xFFFFFFFF in (compressed_size, size)
+        ):
+            return extract_zip_fallback(view)
+        start = offset + LOCAL_HEADER.size + name_length + extra_length
+        end = start + compressed_size
+        if end > len(view):
+            raise zipfile.BadZipFile("Truncated zip entry")
+        if method == STORED:
+            content = bytes(view[start:end])
+        else:
+            content = zlib.decompress(view[start:end], -15, max(size, 1))
+        if len(content) != size or zlib.crc32(content) != crc:
+            raise zipfile.BadZipFile("Bad CRC-32 or size of zip entry")
+        entries.append(content)
+        offset = end
+    return entries
+
+
+def extract_zip_fallback(data: bytes | bytearray | memoryview) -> list[bytes]:
+    with zipfile.ZipFile(io.BytesIO(data), "r") as zip_ref:
+        return [zip_ref.read(name) for name in zip_ref.namelist()]
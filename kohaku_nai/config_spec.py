@@ -6,13 +6,72 @@ class GenServerAuth(TypedDict):
     save_path: str
     free_only: bool
     custom_sub_folder: bool
+    max_priority: int
+    # allow /admin endpoints
+    admin: bool
+    # fair share group name, entries with the same group share one queue
+    group: str
+    # relative share of tokens when groups compete, default 1
+    share: float
+    # max running requests of the group, 0 for unlimited
+    max_concurrency: int
+
+
+class GenServerPool(TypedDict):
+    name: str
+    tokens: list[str]
+    # pools whose idle tokens this pool may borrow
+    spillover: list[str]
+
+
+class GenServerRoute(TypedDict):
+    pool: str
+    # glob patterns of model names, e.g. "nai-diffusion-4-*"
+    models: list[str]
+    # "free" (passes free_check) or "paid"
+    cost: str
+    # auth groups, see GenServerAuth.group
+    groups: list[str]
 
 
 class GenServerConfig(TypedDict):
     host: str
     port: int
+    # seconds to wait for NAI when checking a token at startup
+    token_check_timeout: float
+    # tokens checked at the same time
+    token_check_concurrency: int
+    # /healthz is ready once this many tokens are live
+    min_ready_tokens: int
+    # number of server processes, they share the port and lease tokens from
+    # each other through a SQLite database
+    workers: int
+    # lease database, defaults to .knai-leases.db next to the config file
+    # set it to share tokens with servers started separately
+    coordinator_path: str
+    # seconds until the leases of a crashed process are freed
+    lease_ttl: float
+    # how often queued requests re-check tokens used by other processes
+    lease_poll_interval: float
+    # seconds between checks of the config file for changes, 0 to disable
+    # (POST /admin/reload and SIGHUP always work)
+    config_watch_interval: float
+    # upper bound of concurrent generations, 0 means number of tokens
     max_jobs: int
+    # adaptive concurrency: lower bound, additive step and multiplicative factor
+    concurrency_min: int
+    concurrency_increase: float
+    concurrency_decrease: float
+    # responses slower than tolerance * average latency don't raise the limit
+    concurrency_latency_tolerance: float
+    # min seconds between requests of one token, used when token_rate is 0
     min_delay: float
+    # requests per second of one token
+    token_rate: float
+    # requests one token can make at once after being idle
+    token_burst: int
+    # random extra delay when a token has to wait for its rate limit
+    token_jitter: float
     save_path: str
     token: str
     always_require_auth: bool
@@ -24,4 +83,83 @@ class GenServerConfig(TypedDict):
     compression_quality: int
     # [0, 6]
     compression_method: int
+    # number of processes for webp encoding, 0 means min(4, cpu count)
+    encode_workers: int
+    # max encoding jobs queued or running, 0 means 4 * encode_workers
+    encode_queue_size: int
+    # number of background save workers
+    save_workers: int
+    # max images waiting to be saved before /gen starts to wait
+    save_queue_size: int
+    # max images written in one batch
+    save_batch_size: int
+    # "none", "file" or "full" (also fsync the directory)
+    save_fsync: str
+    # cache images of fixed seed requests
+    cache_enabled: bool
+    # size limit of in-memory cache in MiB
+    cache_memory_size: float
+    # seconds to keep finished jobs for /jobs/{id}
+    job_result_ttl: float
+    # record /jobs in this SQLite file to resume them after a restart,
+    # empty to disable (with several workers each slot gets its own file)
+    job_journal_path: str
+    # "off", "normal" or "full"
+    job_journal_sync: str
+    # seconds to wait for open connections and then for running jobs on
+    # shutdown, unfinished jobs resume on restart
+    drain_timeout: float
+    # keep login sessions valid across restarts, random if empty
+    session_secret: str
+    # max images in one /gen/batch request
+    max_batch_size: int
+    # size limit of NAI's response in MiB, larger responses are rejected
+    max_response_size: float
+    # max n_samples of one request
+    max_samples: int
+    # max queued or running requests, extra ones get 429 (0 for unlimited)
+    max_queue_size: int
+    max_queue_per_session: int
+    # priority -> max queued or running requests of that priority
+    max_queue_per_priority: dict[str, int]
+    # named token pools, tokens not in any pool form the "default" pool which
+    # can borrow from every pool
+    pools: list[GenServerPool]
+    # first matching route picks the pool of a request, else "default"
+    routes: list[GenServerRoute]
+    # how to pick among free tokens: "first", "lru", "ewma" or "p2c"
+    token_selection: str
+    # duplicate slow requests on an idle token, first success wins
+    hedge_enabled: bool
+    # hedge requests slower than this percentile of recent latencies
+    hedge_percentile: float
+    # but never before this many seconds
+    hedge_min_delay: float
+    # max hedged requests as a fraction of all requests
+    hedge_budget: float
+    # fair share across "auth" entries, "session"s or "sub_folder"s of an
+    # auth entry, "" (default) serves by priority only
+    fair_share_by: str
+    # priority gained per second of waiting in queue
+    priority_aging: float
+    # priority -> seconds after which a waiter is served before everyone else
+    max_wait_per_priority: dict[str, float]
+    # base cooldown of a failed token
+    retry_delay: float
+    max_retries: int
+    retry_status_code: list[int]
+    # cooldown doubles on every consecutive failure up to this
+    breaker_max_delay: float
+    # consecutive failures before a token cools down
+    breaker_failure_threshold: int
+    # consecutive auth failures before a token is disabled
+    breaker_quarantine_after: int
+    # expose prometheus metrics on /metrics
+    metrics_enabled: bool
+    # requests slower than this (seconds) are kept for /admin/slow_requests
+    trace_slow_threshold: float
+    # number of slow requests to keep
+    trace_buffer_size: int
+    # write spans as OTLP/JSON lines to this file, empty to disable
+    trace_export_path: str
     auth: list[GenServerAuth]
@@ -19,3 +19,26 @@ class GenerateRequest(BaseModel):
     extra_infos: str = ""
     priority: int = 1
     model: str = "nai-diffusion-3"
+    # number of images generated in one upstream call
+    n_samples: int = 1
+    # skip the result cache for this request
+    no_cache: bool = False
+    # seconds to wait for a free token before giving up, 0 for no deadline
+    deadline: float = 0
+
+
+class BatchGenerateRequest(BaseModel):
+    # explicit list of requests
+    requests: list[GenerateRequest] = []
+    # or `count` requests from `template` with seed, seed+1, ...
+    # (random seeds if template.seed is -1)
+    template: GenerateRequest | None = None
+    count: int = 0
+
+    def expand(self) -> list[GenerateRequest]:
+        requests = list(self.requests)
+        if self.template is not None:
+            for i in range(self.count):
+                seed = -1 if self.template.seed == -1 else self.template.seed + i
+                requests.append(self.template.model_copy(update={"seed": seed}))
+        return requests
@@ -3,57 +3,284 @@ import os
 import re
 import json
 import time
-import random
+import socket
+import multiprocessing
+import io
+import base64
+import signal
+import zipfile
 import click
-import heapq
+from contextlib import asynccontextmanager
+from typing import Any
 from uvicorn import Config, Server
-from concurrent.futures import ThreadPoolExecutor
 from uuid import uuid4
-from hashlib import sha3_256
 
 import toml
 from snowflake import SnowflakeGenerator
 
 from fastapi import FastAPI, Request, Response
+from fastapi.responses import StreamingResponse, PlainTextResponse
 from starlette.middleware.sessions import SessionMiddleware
 
 from kohaku_nai.api import (
-    generate_novelai_image,
+    generate_novelai_images,
+    make_payload,
     HttpClient,
     make_client,
+    close_client,
 )
-from kohaku_nai.utils import (
-    free_check,
-    image_from_bytes,
-    process_image_as_webp,
-)
-from kohaku_nai.request import GenerateRequest
+from kohaku_nai.utils import free_check
+from kohaku_nai.request import GenerateRequest, BatchGenerateRequest
 from kohaku_nai.config_spec import GenServerConfig
+from kohaku_nai.server_modules.scheduler import TokenScheduler, DEFAULT_POOL
+from kohaku_nai.server_modules.breaker import CircuitBreaker
+from kohaku_nai.server_modules.ratelimit import TokenBucket
+from kohaku_nai.server_modules.limiter import AIMDLimiter
+from kohaku_nai.server_modules.selection import TokenStats, get_strategy
+from kohaku_nai.server_modules import metrics
+from kohaku_nai.server_modules.tracing import TracingMiddleware, span, tracer
+from kohaku_nai.server_modules.encoder import ImageEncoder
+from kohaku_nai.server_modules.saver import FSYNC_POLICIES, SaveQueue
+from kohaku_nai.server_modules.cache import ResultCache, payload_key
+from kohaku_nai.server_modules.singleflight import SingleFlight
+from kohaku_nai.server_modules.jobs import (
+    Job,
+    JobManager,
+    PENDING,
+    RUNNING,
+    DONE,
+    FAILED,
+    FINISHED_STATES,
+)
+from kohaku_nai.server_modules.admission import AdmissionControl
+from kohaku_nai.server_modules.routing import Router
+from kohaku_nai.server_modules.hedging import Hedger
+from kohaku_nai.server_modules.reload import RESTART_KEYS, diff_config, watch_file
+from kohaku_nai.server_modules.coordinator import LeaseCoordinator
+from kohaku_nai.server_modules.journal import SYNC_MODES, JobJournal, lookup
 
 
+# Replaced by the worker id of the coordinator in multi-process mode
 id_gen = SnowflakeGenerator(1)
+coordinator: None | LeaseCoordinator = None
+# Journals of the other worker processes, /jobs/{id} looks up their jobs there
+peer_journals: list[str] = []
+# Shared by all worker processes so a session works on any of them
+SESSION_SECRET_ENV = "KOHAKU_NAI_SESSION_SECRET"
 
 server_config: None | GenServerConfig = None
 auth_configs: list[GenServerConfig] = []
 nai_clients: dict[str, "NAILocalClient"] = {}
+# Tokens still being checked, not in nai_clients yet
+token_checks: dict[str, asyncio.Task] = {}
+token_list: list[str] = []
 retry_list: set[int] = set()
-prev_gen_time = time.time()
-priority_queue = []
+scheduler: None | TokenScheduler = None
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    await shutdown()
+
+
+app = FastAPI(lifespan=lifespan)
+app.add_middleware(
+    SessionMiddleware, secret_key=os.environ.get(SESSION_SECRET_ENV) or uuid4().hex
+)
+app.add_middleware(TracingMiddleware)
+
+encoder: None | ImageEncoder = None
+save_queue: None | SaveQueue = None
+result_cache: None | ResultCache = None
+inflight_requests = SingleFlight()
+job_manager: None | JobManager = None
+admission: None | AdmissionControl = None
+hedger: None | Hedger = None
+router: None | Router = None
+config_path = "config.toml"
+reload_lock = asyncio.Lock()
+background_tasks: set[asyncio.Task] = set()
+
+
+def bucket_args() -> tuple[float, int, float]:
+    rate = server_config.get("token_rate", 0)
+    if not rate and server_config.get("min_delay", 0) > 0:
+        rate = 1 / server_config["min_delay"]
+    return (
+        rate,
+        server_config.get("token_burst", 1),
+        server_config.get("token_jitter", 0.3),
+    )
+
+
+def make_bucket() -> TokenBucket:
+    return TokenBucket(*bucket_args())
+
+
+def configure_breaker(breaker: CircuitBreaker):
+    breaker.base_delay = server_config.get("retry_delay", 5.0)
+    breaker.max_delay = server_config.get("breaker_max_delay", 300.0)
+    breaker.failure_threshold = server_config.get("breaker_failure_threshold", 1)
+    breaker.quarantine_after = server_config.get("breaker_quarantine_after", 3)
+    breaker.retry_status_codes = retry_list
+
+
+def priority_table(key: str, config: GenServerConfig | None = None) -> dict[int, Any]:
+    # toml table keys are strings
+    config = server_config if config is None else config
+    return {int(priority): value for priority, value in config.get(key, {}).items()}
 
-app = FastAPI()
-app.add_middleware(SessionMiddleware, secret_key=uuid4().hex)
 
-generate_semaphore: None | asyncio.Semaphore = None
-save_worker = ThreadPoolExecutor(16)
+def config_tokens(
+    config: GenServerConfig | None = None,
+) -> tuple[list[str], dict[str, str]]:
+    """
+    All configured tokens (without duplicates) and the pool of pooled tokens.
+    """
+    config = server_config if config is None else config
+    tokens = list(config.get("tokens", []))
+    if token := config.get("token", None):
+        tokens.append(token)
+    token_pools = {}
+    for pool in config.get("pools", []):
+        for pool_token in pool.get("tokens", []):
+            token_pools[pool_token] = pool["name"]
+            tokens.append(pool_token)
+    return list(dict.fromkeys(tokens)), token_pools
+
+
+def limiter_args(n_tokens: int) -> tuple:
+    # max_jobs is the upper bound, the actual limit adapts to NAI's responses
+    return (
+        server_config.get("max_jobs", 0) or n_tokens or 1,
+        server_config.get("concurrency_min", 1),
+        server_config.get("concurrency_increase", 1.0),
+        server_config.get("concurrency_decrease", 0.5),
+        server_config.get("concurrency_latency_tolerance", 2.0),
+    )
+
+
+def validate_config(config: GenServerConfig):
+    """
+    Raise ValueError if the config can't be applied, checked before any of it
+    is, so a bad reload leaves the running server untouched.
+    """
+    for pool in config.get("pools", []):
+        if "name" not in pool:
+            raise ValueError("Token pools need a name")
+    if not config_tokens(config)[0]:
+        raise ValueError("No token provided, please set 'tokens' in config.toml")
+    get_strategy(config.get("token_selection", "p2c"))
+    try:
+        router = Router(config.get("routes", []))
+    except (AssertionError, TypeError) as e:
+        raise ValueError(f"Invalid route: {e}") from e
+    known_pools = {DEFAULT_POOL} | {pool["name"] for pool in config.get("pools", [])}
+    if unknown_pools := router.pools - known_pools:
+        raise ValueError(f"Routes to unknown token pools: {sorted(unknown_pools)}")
+    for key in ("max_wait_per_priority", "max_queue_per_priority"):
+        try:
+            priority_table(key, config)
+        except ValueError as e:
+            raise ValueError(f"Keys of {key} must be priorities") from e
+    for auth in config.get("auth", []):
+        if not auth.get("share", 1.0) > 0:
+            raise ValueError("Auth share must be positive")
+    if not 0 < config.get("hedge_percentile", 0.95) < 1:
+        raise ValueError("hedge_percentile must be in (0, 1)")
+    if not 0 <= config.get("compression_quality", 75) <= 100:
+        raise ValueError("compression_quality must be in [0, 100]")
+    if not 0 <= config.get("compression_method", 4) <= 6:
+        raise ValueError("compression_method must be in [0, 6]")
+    if config.get("save_fsync", "none") not in FSYNC_POLICIES:
+        raise ValueError(f"save_fsync must be one of {FSYNC_POLICIES}")
+    if config.get("job_journal_sync", "normal").upper() not in SYNC_MODES:
+        raise ValueError('job_journal_sync must be "off", "normal" or "full"')
+
+
+def configure_scheduler():
+    """
+    Apply the scheduling settings, token pools, routes and auth groups.
+    """
+    global router
+    pools = server_config.get("pools", [])
+    router = Router(server_config.get("routes", []))
+    known_pools = {DEFAULT_POOL} | {pool["name"] for pool in pools}
+    scheduler.aging = server_config.get("priority_aging", 0.0)
+    scheduler.max_wait = priority_table("max_wait_per_priority")
+    scheduler.select = get_strategy(server_config.get("token_selection", "p2c"))
+    # Unassigned tokens form the default pool, it can borrow from every pool.
+    # Pools removed from the config do the same so their queue drains.
+    for name in scheduler.pools.keys() - known_pools | {DEFAULT_POOL}:
+        scheduler.set_pool(name, [pool["name"] for pool in pools])
+    for pool in pools:
+        scheduler.set_pool(pool["name"], pool.get("spillover", []))
+    for auth in auth_configs:
+        scheduler.set_group(
+            auth_group(auth), auth.get("share", 1.0), auth.get("max_concurrency", 0)
+        )
+
+
+def configure_admission():
+    admission.max_total = server_config.get("max_queue_size", 0)
+    admission.max_per_session = server_config.get("max_queue_per_session", 0)
+    admission.max_per_priority = priority_table("max_queue_per_priority")
+
+
+def make_hedger() -> Hedger | None:
+    if not server_config.get("hedge_enabled", False):
+        return None
+    return Hedger(
+        server_config.get("hedge_percentile", 0.95),
+        server_config.get("hedge_min_delay", 5.0),
+        server_config.get("hedge_budget", 0.1),
+    )
+
+
+def make_encoder() -> ImageEncoder | None:
+    if server_config.get("save_directly", False):
+        return None
+    return ImageEncoder(
+        server_config.get("encode_workers", 0),
+        server_config.get("encode_queue_size", 0),
+        server_config.get("compression_quality", 75),
+        server_config.get("compression_method", 4),
+    )
+
+
+def make_result_cache() -> ResultCache | None:
+    if not server_config.get("cache_enabled", True):
+        return None
+    # webp files are not what NAI returned, only raw saves can be reused
+    index_path = ""
+    if server_config.get("save_directly", False):
+        os.makedirs(server_config["save_path"], exist_ok=True)
+        index_path = os.path.join(server_config["save_path"], "cache_index.jsonl")
+    return ResultCache(
+        int(server_config.get("cache_memory_size", 256) * 1024 * 1024), index_path
+    )
+
+
+def configure_tracer():
+    tracer.configure(
+        server_config.get("trace_slow_threshold", 10.0),
+        server_config.get("trace_buffer_size", 100),
+        server_config.get("trace_export_path", ""),
+    )
 
 
 class NAILocalClient:
     def __init__(self, token, client: HttpClient):
         self.token = token
         self.client = client
-        self.error_time = 0
-        self.in_error = False
-        self.lock = asyncio.Lock()
+        self.breaker = CircuitBreaker()
+        configure_breaker(self.breaker)
+        self.bucket = make_bucket()
+        self.stats = TokenStats()
+        # Managed by the scheduler, True while a request is using this client
+        self.leased = False
+        # Set when a config reload dropped the token
+        self.removed = False
 
     @classmethod
     async def create(cls, token):
@@ -66,45 +293,63 @@ class NAILocalClient:
 
     @property
     def available(self):
-        return not self.lock.locked()
+        return not self.leased
 
-    async def disable(self):
-        await self.lock.acquire()
-
-    def enable(self):
-        self.lock.release()
+    @property
+    def name(self):
+        # Never expose the full token
+        return f"{self.token[:4]}...{self.token[-4:]}"
 
     async def __aenter__(self) -> HttpClient:
-        await self.lock.acquire()
+        # The scheduler already leased this client to us
         return self.client
 
     async def __aexit__(self, exc_type, exc_val, exc_tb):
-        self.enable()
-
-
-def save_img(save_path: str, sub_folder: str, image: bytes, json: str):
-    if not save_path:
-        save_path = server_config["save_path"]
-    sub_folder_path = os.path.join(save_path, sub_folder)
-    os.makedirs(sub_folder_path, exist_ok=True)
-    is_separate_metadata = server_config.get("separate_metadata", False)
-    metadata_dir = "metadatas"
-    if is_separate_metadata:
-        os.makedirs(os.path.join(sub_folder_path, metadata_dir), exist_ok=True)
-
-    img_hash = sha3_256(image).hexdigest()
-    img_id = next(id_gen)
-    img_extension = "png" if server_config.get("save_directly", False) else "webp"
-    img_name = f"{img_id}_{img_hash[:8]}.{img_extension}"
-
-    with open(os.path.join(sub_folder_path, img_name), "wb") as f:
-        f.write(image)
-    if is_separate_metadata:
-        metadata_name = f"{img_id}_{img_hash[:8]}.json"
-        with open(
-            os.path.join(sub_folder_path, metadata_dir, metadata_name), "w", encoding="utf-8"
-        ) as f:
-            f.write(json)
+        scheduler.release(self)
+        if self.removed:
+            await self.close()
+
+    async def close(self):
+        try:
+            await close_client(self.client)
+        except Exception as e:
+            print(f"Failed to close client {self.name}: {e!r}")
+
+
+async def create_client(token: str, checks: asyncio.Semaphore):
+    """
+    Validate a token and hand it to the scheduler as soon as it is live.
+    """
+    try:
+        async with checks:
+            try:
+                client = await asyncio.wait_for(
+                    NAILocalClient.create(token),
+                    server_config.get("token_check_timeout", 30.0),
+                )
+            except Exception as e:
+                print(f"Token check failed: {e!r}")
+                client = None
+    finally:
+        if token_checks.get(token) is asyncio.current_task():
+            del token_checks[token]
+    if client is None:
+        print(f"Failed to create client for {token}")
+    else:
+        # The pool may have changed by a reload during the check
+        scheduler.add_client(client, config_tokens()[1].get(token, DEFAULT_POOL))
+    nai_clients[token] = client
+
+
+def check_tokens(tokens: list[str]) -> list[asyncio.Task]:
+    """
+    Start checking tokens in the background, tracked in token_checks so a
+    reload doesn't check a token twice.
+    """
+    checks = asyncio.Semaphore(server_config.get("token_check_concurrency", 8))
+    for token in tokens:
+        token_checks[token] = spawn(create_client(token, checks))
+    return [token_checks[token] for token in tokens]
 
 
 @app.post("/login")
@@ -118,49 +363,57 @@ async def login(password: str, request: Request):
             )
             request.session["custom_sub_folder"] = auth.get("custom_sub_folder", False)
             request.session["max_priority"] = auth.get("max_priority", 1)
+            request.session["admin"] = auth.get("admin", False)
+            request.session["group"] = auth_group(auth)
             return {"status": "login success"}
     request.session.clear()
     return Response(json.dumps({"status": "login failed"}), 403)
 
 
-async def get_available_client(priority: int = 0) -> NAILocalClient:
-    global priority_queue
-    request_time = time.time()
-    priority_info = (-priority, request_time)
-    heapq.heappush(priority_queue, priority_info)
-    while True:
-        if priority_queue[0] is not priority_info:
-            await asyncio.sleep(0)
-            continue
-        for client in nai_clients.values():
-            if client is None:
-                continue
-            if not client.available:
-                # Not available
-                continue
-            elif not client.in_error:
-                # available + no error
-                break
-            elif time.time() >= client.error_time + server_config["retry_delay"]:
-                # available + in error + retry delay passed
-                client.in_error = False
-                break
-            else:
-                # in error + retry delay not passed
-                # Use asyncio.sleep to yield control to the event loop
-                await asyncio.sleep(0)
-                continue
+async def get_available_client(
+    priority: int = 0,
+    deadline: float | None = None,
+    group: str = "",
+    pool: str = DEFAULT_POOL,
+) -> NAILocalClient:
+    """
+    Wait for a client, raise TimeoutError if none is free before `deadline`.
+    """
+    start_time = time.time()
+    with span("queue", priority=priority, group=group, pool=pool) as queue_span:
+        if deadline is None:
+            client = await scheduler.acquire(priority, group, pool)
         else:
-            # No client available
-            # Use asyncio.sleep to yield control to the event loop
-            await asyncio.sleep(0)
-            continue
-        heapq.heappop(priority_queue)
-        break
+            client = await asyncio.wait_for(
+                scheduler.acquire(priority, group, pool),
+                max(deadline - start_time, 0),
+            )
+        if queue_span is not None:
+            queue_span.attrs["token"] = client.name
+    metrics.QUEUE_WAIT.observe(time.time() - start_time, priority)
     return client
 
 
+def error_status_code(response) -> int | None:
+    if response is None:
+        return None
+    try:
+        return int(response.json()["statusCode"])
+    except Exception:
+        return getattr(response, "status_code", None)
+
+
 def make_error(error_mes, response, retry_count):
+    if response is None:
+        # No response from NAI, retry like retryable errors
+        if retry_count >= server_config["max_retries"]:
+            return Response(
+                json.dumps(
+                    {"error-mes": "Exceed max retries for NAI errors", "status": error_mes}
+                ),
+                500,
+            )
+        return None
     try:
         error_response = response.json()
         if (
@@ -184,10 +437,211 @@ def make_error(error_mes, response, retry_count):
     return Response(json.dumps({"error-mes": error_mes, "status": error_response}), 500)
 
 
-@app.post("/gen")
-async def gen(context: GenerateRequest, request: Request):
-    global prev_gen_time
+def make_generate_args(context: GenerateRequest):
+    return {
+        "prompt": context.prompt,
+        "quality_tags": False,
+        "negative_prompt": context.neg_prompt,
+        "ucpreset": "",
+        "seed": context.seed,
+        "scale": context.scale,
+        "width": context.width,
+        "height": context.height,
+        "steps": context.steps,
+        "sampler": context.sampler,
+        "schedule": context.schedule,
+        "smea": context.smea,
+        "dyn": context.dyn,
+        "dyn_threshold": context.dyn_threshold,
+        "cfg_rescale": context.cfg_rescale,
+        "model": context.model,
+        "n_samples": context.n_samples,
+    }
+
+
+def make_image_response(images: list[bytes], headers: dict[str, str]) -> Response:
+    """
+    Single image is returned as png, multiple images as a zip like NAI does.
+    """
+    if len(images) == 1:
+        return Response(images[0], media_type="image/png", headers=headers)
+    zip_file = io.BytesIO()
+    with zipfile.ZipFile(zip_file, "w", zipfile.ZIP_STORED) as zip_ref:
+        for idx, image in enumerate(images):
+            zip_ref.writestr(f"image_{idx}.png", image)
+    return Response(zip_file.getvalue(), media_type="application/zip", headers=headers)
+
+
+def read_image_response(response: Response) -> list[bytes]:
+    if response.media_type != "application/zip":
+        return [response.body]
+    with zipfile.ZipFile(io.BytesIO(response.body), "r") as zip_ref:
+        return [zip_ref.read(name) for name in zip_ref.namelist()]
+
+
+async def upstream_call(
+    client: NAILocalClient, generate_args: dict[str, Any], hedge: bool = False
+) -> tuple[list[bytes] | str, Any]:
+    """
+    Run one NAI request on a leased client, record the outcome and release it.
+    Return the images (or error message) and the json payload (or response).
+    """
+    async with client as http_client:
+        start_time = time.time()
+        with span("upstream", token=client.name, hedge=hedge) as upstream_span:
+            try:
+                # The metadata json is only built if it gets saved
+                images, json_payload = await generate_novelai_images(
+                    **generate_args,
+                    client=http_client,
+                    dump_payload=False,
+                    max_response_size=int(
+                        server_config.get("max_response_size", 256) * 1024 * 1024
+                    ),
+                )
+            except Exception as e:
+                # Network errors and timeouts
+                images, json_payload = f"Request to NAI failed: {e}", None
+            error = not isinstance(images, list)
+            status_code = error_status_code(json_payload) if error else 200
+            if upstream_span is not None:
+                upstream_span.attrs["status"] = status_code
+        latency = time.time() - start_time
+        # 429 from NAI or no response at all means we are pushing too hard
+        overloaded = error and (status_code == 429 or json_payload is None)
+        metrics.UPSTREAM_LATENCY.observe(latency, client.name)
+        metrics.UPSTREAM_REQUESTS.inc(client.name, status_code)
+        # Apply error status to client before we release it
+        if error:
+            metrics.UPSTREAM_ERRORS.inc(client.name, status_code)
+            client.breaker.record_failure(status_code)
+        else:
+            client.breaker.record_success()
+            admission.record_completion()
+            if hedger is not None:
+                hedger.record(latency)
+        client.bucket.record(not error, overloaded)
+        client.stats.record(latency, not error)
+        scheduler.limiter.record(not error, latency, overloaded)
+    return images, json_payload
+
+
+async def hedged_call(
+    client: NAILocalClient, generate_args: dict[str, Any], group: str, pool: str
+) -> tuple[list[bytes] | str, Any, NAILocalClient]:
+    """
+    Run the request on `client`. With hedging on, once it is slower than the
+    recent latency percentile and a token is idle, a copy runs on that token.
+    The first successful result wins and the other request is cancelled.
+    Return the result of `upstream_call` and the client which produced it.
+    """
+    if hedger is None:
+        return *(await upstream_call(client, generate_args)), client
+    hedger.budget.deposit()
+    start_time = time.time()
+    primary = asyncio.create_task(upstream_call(client, generate_args))
+    tasks = {primary: client}
+    try:
+        if (delay := hedger.delay()) is not None:
+            await asyncio.wait((primary,), timeout=delay)
+        if primary.done() or delay is None or not hedger.budget.available():
+            return *(await primary), client
+        hedge_client = scheduler.try_acquire(group, pool)
+        if hedge_client is None:
+            return *(await primary), client
+        hedger.budget.withdraw()
+        hedger.stats["hedged"] += 1
+        hedge = asyncio.create_task(
+            upstream_call(hedge_client, generate_args, hedge=True)
+        )
+        tasks[hedge] = hedge_client
+        done, pending = await asyncio.wait(
+            tasks, return_when=asyncio.FIRST_COMPLETED
+        )
+        winner = done.pop()
+        if not isinstance(winner.result()[0], list) and pending:
+            # First one failed, the other may still succeed
+            winner = pending.pop()
+            await winner
+        if winner is hedge and not primary.done():
+            # The primary lost and gets cancelled below, the elapsed time is
+            # a lower bound of its latency
+            client.stats.record(time.time() - start_time, True)
+        hedger.stats["hedge_won" if winner is hedge else "primary_won"] += 1
+        metrics.UPSTREAM_HEDGES.inc("hedge" if winner is hedge else "primary")
+        return *winner.result(), tasks[winner]
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+async def generate_images(
+    generate_args: dict[str, Any],
+    priority: int,
+    deadline: float | None = None,
+    group: str = "",
+    pool: str = DEFAULT_POOL,
+) -> tuple[list[bytes], str] | Response:
+    """
+    Generate images with the first available client, retry on NAI errors.
+    Give up if no client is free before `deadline` (unix time).
+    `group` is the fair share group and `pool` the token pool of the request.
+    Return the images and the json payload, or an error response.
+    """
+    retry_count = 0
+    while True:
+        try:
+            client = await get_available_client(priority, deadline, group, pool)
+        except asyncio.TimeoutError:
+            # Dropped before dispatch, no upstream generation was spent
+            metrics.DROPPED_REQUESTS.inc("deadline", "queued")
+            return Response(json.dumps({"status": "Deadline exceeded"}), 504)
+        images, json_payload, client = await hedged_call(
+            client, generate_args, group, pool
+        )
+        error = not isinstance(images, list)
+        if error:
+            print(f"Error from NAI: {images}")
+            if json_payload is not None:
+                print(json_payload.text)
+            error_mes = images
+            response = json_payload
+            err_resp = make_error(error_mes, response, retry_count)
+            if err_resp:
+                return err_resp
+            metrics.UPSTREAM_RETRIES.inc(client.name)
+            retry_count += 1
+        else:
+            return images, json_payload
+
+
+def auth_group(auth: dict[str, Any]) -> str:
+    """Fair share group of an auth entry, its `group` or its index."""
+    return auth.get("group", "") or f"auth{auth_configs.index(auth)}"
+
+
+def share_group(request: Request, sub_folder: str) -> str:
+    """
+    Fair share group of a request according to `fair_share_by`.
+    """
+    fair_share_by = server_config.get("fair_share_by", "")
+    if not fair_share_by:
+        return ""
+    group = request.session.get("group", "anonymous")
+    if fair_share_by == "session":
+        group = f"{group}/{session_id(request)}"
+    elif fair_share_by == "sub_folder":
+        group = f"{group}/{sub_folder}"
+    return group
+
 
+def check_request(
+    context: GenerateRequest, request: Request
+) -> dict[str, Any] | Response:
+    """
+    Check the permission of the request and resolve the save target.
+    Return the options for `process_request`, or an error response.
+    """
     is_signed = request.session.get("signed", False)
     is_free_only = request.session.get("free_only", True)
     # no max_priority means the user is not login
@@ -203,9 +657,16 @@ async def gen(context: GenerateRequest, request: Request):
             403,
         )
     is_always_require_auth = server_config.get("always_require_auth", True)
-    is_free_gen = free_check(context.width, context.height, context.steps)
+    is_free_gen = free_check(
+        context.width, context.height, context.steps, context.n_samples
+    )
+    max_samples = server_config.get("max_samples", 4)
+    if not 1 <= context.n_samples <= max_samples:
+        return Response(
+            json.dumps({"status": f"n_samples must be in [1, {max_samples}]"}), 400
+        )
 
-    save_path = request.session.get("save_path", server_config["save_path"])
+    save_path = request.session.get("save_path", "") or server_config["save_path"]
     if request.session.get("custom_sub_folder", False):
         sub_folder = context.img_sub_folder or extra_infos.get("save_folder", "")
     else:
@@ -217,103 +678,850 @@ async def gen(context: GenerateRequest, request: Request):
     ):
         return Response(json.dumps({"status": "Config not allowed"}), 403)
 
-    retry_count = 0
-    while True:
-        client = await get_available_client(priority)
-        async with client as http_client:
-            async with generate_semaphore:
-                if prev_gen_time + server_config["min_delay"] > time.time():
-                    await asyncio.sleep(
-                        server_config["min_delay"] + random.random() * 0.3
-                    )
-                prev_gen_time = time.time()
-
-                img_bytes, json_payload = await generate_novelai_image(
-                    context.prompt,
-                    False,
-                    context.neg_prompt,
-                    "",
-                    context.seed,
-                    context.scale,
-                    context.width,
-                    context.height,
-                    context.steps,
-                    context.sampler,
-                    context.schedule,
-                    context.smea,
-                    context.dyn,
-                    context.dyn_threshold,
-                    context.cfg_rescale,
-                    context.model,
-                    client=http_client,
+    return {
+        "priority": priority,
+        "save_path": save_path,
+        "sub_folder": safe_folder_name,
+        "deadline": time.time() + context.deadline if context.deadline > 0 else None,
+        "group": share_group(request, safe_folder_name),
+        "pool": router.route(
+            context.model,
+            "free" if is_free_gen else "paid",
+            request.session.get("group", "anonymous"),
+        ),
+    }
+
+
+async def process_request(
+    context: GenerateRequest,
+    priority: int,
+    save_path: str,
+    sub_folder: str,
+    deadline: float | None = None,
+    group: str = "",
+    pool: str = DEFAULT_POOL,
+) -> Response:
+    generate_args = make_generate_args(context)
+    # Only generation with fixed seed is deterministic
+    cache_key = None
+    if context.seed != -1:
+        payload = make_payload(**generate_args)
+        cache_key = payload_key(payload)
+    if result_cache is not None and cache_key is not None:
+        if context.no_cache:
+            result_cache.bypass()
+        else:
+            with span("cache") as cache_span:
+                images = await result_cache.get(cache_key)
+                if cache_span is not None:
+                    cache_span.attrs["hit"] = images is not None
+            if images is not None:
+                # Saved by an earlier request, maybe to another folder
+                if result_cache.claim_save(
+                    cache_key, os.path.join(save_path, sub_folder)
+                ):
+                    for image in images:
+                        await save_queue.put(save_path, sub_folder, image, payload)
+                return make_image_response(
+                    images, {"X-Cache": "HIT", "X-Seed": str(context.seed)}
                 )
-            error = not isinstance(img_bytes, bytes)
-            if error:
-                # Apply error status to client before we release it
-                client.in_error = True
-                client.error_time = time.time()
 
-        if error:
-            print(f"Error from NAI: {img_bytes}")
-            print(json_payload.json())
-            error_mes = img_bytes
-            response = json_payload
-            err_resp = make_error(error_mes, response, retry_count)
-            if err_resp:
-                return err_resp
-            retry_count += 1
+    async def generate_and_cache():
+        result = await generate_images(
+            generate_args, priority, deadline, group, pool
+        )
+        if result_cache is not None and not isinstance(result, Response):
+            result_cache.put(cache_key, result[0])
+        return result
+
+    if cache_key is None:
+        result = await generate_images(
+            generate_args, priority, deadline, group, pool
+        )
+        need_save = True
+    else:
+        # Identical requests in flight share one upstream generation
+        result, call = await inflight_requests.do(cache_key, generate_and_cache)
+        need_save = call.claim((save_path, sub_folder))
+    if isinstance(result, Response):
+        return result
+    images, json_payload = result
+
+    if need_save:
+        # Encoding and saving happen in background, don't let the caller wait for it
+        save_futures = [
+            await save_queue.put(save_path, sub_folder, image, json_payload)
+            for image in images
+        ]
+        if result_cache is not None and cache_key is not None:
+            result_cache.claim_save(cache_key, os.path.join(save_path, sub_folder))
+            asyncio.gather(*save_futures).add_done_callback(
+                lambda future: result_cache.record_disk(cache_key, future)
+            )
+
+    # The seed NAI used, random ones are only known from the payload
+    seed = json_payload["parameters"]["seed"]
+    return make_image_response(images, {"X-Cache": "MISS", "X-Seed": str(seed)})
+
+
+def session_id(request: Request) -> str:
+    if "id" not in request.session:
+        request.session["id"] = uuid4().hex
+    return request.session["id"]
+
+
+def admit(request: Request, priority: int) -> Response | None:
+    """
+    Reserve a queue slot for the request, return a 429 response if it is full.
+    """
+    retry_after = admission.try_admit(session_id(request), priority)
+    if retry_after is None:
+        return None
+    return Response(
+        json.dumps({"status": "Queue is full", "retry_after": retry_after}),
+        429,
+        headers={"Retry-After": str(retry_after)},
+    )
+
+
+def submit_request(
+    context: GenerateRequest, request: Request, options: dict[str, Any], keep: bool
+) -> Job | Response:
+    """
+    Submit an admitted request as a job, its queue slot is given back once the
+    job finishes (also when it is cancelled before starting).
+    """
+    priority = options["priority"]
+    if (rejected := admit(request, priority)) is not None:
+        return rejected
+    return start_job(context, options, session_id(request), keep)
+
+
+def start_job(
+    context: GenerateRequest,
+    options: dict[str, Any],
+    session: str,
+    keep: bool,
+    job_id: str | None = None,
+) -> Job:
+    priority = options["priority"]
+    job = job_manager.submit(
+        process_request(context, **options),
+        priority,
+        session,
+        keep=keep,
+        request=None if job_id else {"context": context.model_dump(), "options": options},
+        job_id=job_id,
+    )
+    job.task.add_done_callback(lambda _: admission.release(session, priority))
+    return job
+
+
+def journal_response(entry: dict[str, Any]) -> Response | None:
+    if entry["result"] is None:
+        return None
+    status_code, media_type, body = entry["result"]
+    return Response(body, status_code, media_type=media_type or None)
+
+
+def resume_jobs():
+    """
+    Restore jobs of the journal: unfinished ones run again, finished ones can
+    be fetched until they expire.
+    """
+    expire_before = time.time() - job_manager.result_ttl
+    resumed = restored = 0
+    for entry in job_manager.journal.load():
+        if entry["status"] in FINISHED_STATES:
+            if entry["finished_at"] < expire_before:
+                continue
+            job_manager.restore(
+                entry["id"],
+                entry["priority"],
+                entry["session"],
+                entry["status"],
+                entry["created_at"],
+                entry["started_at"],
+                entry["finished_at"],
+                journal_response(entry),
+            )
+            restored += 1
+            continue
+        context = GenerateRequest(**entry["request"]["context"])
+        options = entry["request"]["options"]
+        # Already admitted before the restart
+        admission.add(entry["session"], options["priority"])
+        job = start_job(context, options, entry["session"], True, entry["id"])
+        job.created_at = entry["created_at"]
+        resumed += 1
+    if resumed or restored:
+        print(f"Job journal: {resumed} jobs resumed, {restored} results restored")
+
+
+def job_info(job: Job) -> dict[str, Any]:
+    position = scheduler.position(job.ticket)
+    info = {
+        "job_id": job.id,
+        "status": job.status,
+        "priority": job.priority,
+        "created_at": job.created_at,
+        "started_at": job.started_at,
+        "finished_at": job.finished_at,
+        "queue_position": position,
+    }
+    if position is not None:
+        wait = admission.estimate_wait(position)
+        info["estimated_start"] = None if wait is None else time.time() + wait
+    if job.status == DONE:
+        info["result_url"] = f"/jobs/{job.id}/result"
+    elif job.status == FAILED:
+        info["error"] = job.error()
+    return info
+
+
+async def get_job(job_id: str, request: Request) -> Job | Response:
+    """
+    Job of this session, jobs of other worker processes are read from their
+    journals as a snapshot which isn't updated.
+    """
+    job = job_manager.get(job_id)
+    if job is None:
+        for path in peer_journals:
+            entry = await asyncio.to_thread(lookup, path, job_id)
+            if entry is not None:
+                job = Job(entry["priority"], entry["session"], entry["id"])
+                job.status = entry["status"] or PENDING
+                job.created_at = entry["created_at"]
+                job.started_at = entry["started_at"]
+                if job.finished:
+                    job.finished_at = entry["finished_at"]
+                job.response = journal_response(entry)
+                break
+    if job is None or job.session_id != session_id(request):
+        return Response(json.dumps({"status": "Job not found"}), 404)
+    return job
+
+
+def drop_job(job: Job, reason: str):
+    """
+    Cancel an unfinished job, count whether it was dropped before reaching NAI.
+    """
+    stage = "running" if job.status == RUNNING else "queued"
+    metrics.DROPPED_REQUESTS.inc(reason, stage)
+    job.task.cancel()
+
+
+async def wait_disconnect(request: Request):
+    # The body is already read, the next message only comes on disconnect
+    while (await request.receive())["type"] != "http.disconnect":
+        pass
+
+
+@app.post("/gen")
+async def gen(context: GenerateRequest, request: Request):
+    options = check_request(context, request)
+    if isinstance(options, Response):
+        return options
+    job = submit_request(context, request, options, keep=False)
+    if isinstance(job, Response):
+        return job
+    disconnect = asyncio.create_task(wait_disconnect(request))
+    try:
+        await asyncio.wait(
+            (job.task, disconnect), return_when=asyncio.FIRST_COMPLETED
+        )
+    finally:
+        disconnect.cancel()
+        dropped = not job.task.done()
+        if dropped:
+            # The client is gone (or this handler got cancelled)
+            drop_job(job, "disconnect")
+    if dropped:
+        return Response(json.dumps({"status": "Client disconnected"}), 499)
+    return job.task.result()
+
+
+@app.post("/gen/batch")
+async def gen_batch(batch: BatchGenerateRequest, request: Request):
+    """
+    Generate several images in one request.
+    Results are streamed as ndjson in completion order, one line per image:
+        {"index": i, "status": 200, "seed": seed, "images": [base64 png, ...]}
+        {"index": i, "status": code, "error": ...}
+    """
+    contexts = batch.expand()
+    if not contexts:
+        return Response(json.dumps({"status": "Empty batch"}), 400)
+    max_batch_size = server_config.get("max_batch_size", 16)
+    if len(contexts) > max_batch_size:
+        return Response(
+            json.dumps({"status": f"Batch size exceed limit {max_batch_size}"}), 400
+        )
+
+    rejected: list[tuple[int, Response]] = []
+    jobs: list[tuple[int, Job]] = []
+    for index, context in enumerate(contexts):
+        options = check_request(context, request)
+        if isinstance(options, Response):
+            rejected.append((index, options))
+            continue
+        job = submit_request(context, request, options, keep=False)
+        if isinstance(job, Response):
+            rejected.append((index, job))
+            continue
+        jobs.append((index, job))
+
+    async def wait_job(index: int, job: Job):
+        return index, await job.task
+
+    def make_line(index: int, response: Response) -> str:
+        item = {"index": index, "status": response.status_code}
+        if response.status_code == 200:
+            item["seed"] = int(response.headers["X-Seed"])
+            item["images"] = [
+                base64.b64encode(image).decode()
+                for image in read_image_response(response)
+            ]
         else:
-            break
-
-    is_save_raw = server_config.get("save_directly", False)
-    if not is_save_raw:
-        img_pil = image_from_bytes(img_bytes)
-        quality = server_config.get("compression_quality", 75)
-        method = server_config.get("compression_method", 4)
-        assert 0 <= quality <= 100, "Compression quality must be in [0, 100]"
-        assert 0 <= method <= 6, "Compression method must be in [0, 6]"
-        img_webp_bytes = process_image_as_webp(img_pil, quality, method)
-
-    await asyncio.get_running_loop().run_in_executor(
-        save_worker,
-        save_img,
-        save_path,
-        safe_folder_name,
-        img_bytes if is_save_raw else img_webp_bytes,
-        json_payload,
+            try:
+                item["error"] = json.loads(response.body)
+            except json.JSONDecodeError:
+                item["error"] = response.body.decode("utf-8", "replace")
+        return json.dumps(item) + "\n"
+
+    async def result_stream():
+        try:
+            for index, response in rejected:
+                yield make_line(index, response)
+            for next_done in asyncio.as_completed(
+                [wait_job(index, job) for index, job in jobs]
+            ):
+                index, response = await next_done
+                yield make_line(index, response)
+        finally:
+            # Cancel unfinished jobs if the client is gone
+            for _, job in jobs:
+                if not job.task.done():
+                    drop_job(job, "disconnect")
+
+    return StreamingResponse(result_stream(), media_type="application/x-ndjson")
+
+
+@app.post("/jobs")
+async def create_job(context: GenerateRequest, request: Request):
+    if server_config.get("workers", 1) > 1 and not peer_journals:
+        # Other workers couldn't find the job
+        return Response(
+            json.dumps(
+                {"status": "Set job_journal_path to use /jobs with several workers"}
+            ),
+            501,
+        )
+    options = check_request(context, request)
+    if isinstance(options, Response):
+        return options
+    job = submit_request(context, request, options, keep=True)
+    if isinstance(job, Response):
+        return job
+    return job_info(job)
+
+
+@app.get("/jobs/{job_id}")
+async def read_job(job_id: str, request: Request):
+    job = await get_job(job_id, request)
+    if isinstance(job, Response):
+        return job
+    return job_info(job)
+
+
+@app.get("/jobs/{job_id}/result")
+async def read_job_result(job_id: str, request: Request):
+    job = await get_job(job_id, request)
+    if isinstance(job, Response):
+        return job
+    if not job.finished:
+        return Response(json.dumps(job_info(job)), 202)
+    return job.response
+
+
+@app.get("/jobs/{job_id}/events")
+async def job_events(job_id: str, request: Request):
+    """
+    Server-sent events of job status changes, closed once the job is finished.
+    """
+    job = await get_job(job_id, request)
+    if isinstance(job, Response):
+        return job
+
+    async def event_stream():
+        queue = job.subscribe()
+        try:
+            while True:
+                status = await queue.get()
+                # Skip stale states, only the latest one matters
+                while not queue.empty():
+                    status = queue.get_nowait()
+                yield f"event: status\ndata: {json.dumps(job_info(job))}\n\n"
+                if status in FINISHED_STATES:
+                    break
+        finally:
+            job.unsubscribe(queue)
+
+    async def peer_event_stream(job: Job | Response):
+        # Runs in another worker process, poll its journal
+        status = None
+        while isinstance(job, Job):
+            if job.status != status:
+                status = job.status
+                yield f"event: status\ndata: {json.dumps(job_info(job))}\n\n"
+            if job.finished:
+                break
+            await asyncio.sleep(1)
+            job = await get_job(job_id, request)
+
+    if job_manager.get(job_id) is None:
+        return StreamingResponse(peer_event_stream(job), media_type="text/event-stream")
+    return StreamingResponse(event_stream(), media_type="text/event-stream")
+
+
+@app.get("/healthz")
+async def healthz():
+    """
+    Readiness probe, 200 once `min_ready_tokens` tokens are live.
+    """
+    live = len(scheduler.clients) if scheduler is not None else 0
+    failed = sum(client is None for client in nai_clients.values())
+    min_ready = min(server_config.get("min_ready_tokens", 1), len(token_list))
+    ready = bool(token_list) and live >= min_ready
+    info = {
+        "status": "ready" if ready else "starting",
+        "live_tokens": live,
+        "failed_tokens": failed,
+        "pending_tokens": len(token_list) - len(nai_clients),
+        "worker_id": None if coordinator is None else coordinator.worker_id,
+    }
+    return Response(json.dumps(info), 200 if ready else 503)
+
+
+@app.get("/metrics")
+async def read_metrics():
+    if not server_config.get("metrics_enabled", True):
+        return Response(json.dumps({"status": "Metrics disabled"}), 404)
+    return PlainTextResponse(
+        metrics.generate_latest(), media_type="text/plain; version=0.0.4"
     )
 
-    return Response(img_bytes, media_type="image/png")
+
+def is_admin(request: Request) -> bool:
+    return request.session.get("admin", False)
 
 
-async def main(config: str):
-    global server_config, auth_configs, generate_semaphore, nai_clients, retry_list
+@app.get("/admin/tokens")
+async def admin_tokens(request: Request):
+    if not is_admin(request):
+        return Response(json.dumps({"status": "Admin only"}), 403)
+    tokens = [
+        {
+            "index": idx,
+            "name": client.name,
+            "leased": client.leased,
+            "pool": client.pool,
+            **client.breaker.info(),
+            "rate_limit": client.bucket.info(),
+            "stats": client.stats.info(),
+        }
+        for idx, client in enumerate(scheduler.clients)
+    ]
+    return {
+        "available": sum(
+            not client.leased and client.breaker.available(time.time())
+            for client in scheduler.clients
+        ),
+        "total": len(tokens),
+        "queue_size": scheduler.queue_size,
+        "in_flight": scheduler.in_flight,
+        "concurrency": scheduler.limiter.info(),
+        "selection": server_config.get("token_selection", "p2c"),
+        "hedging": None if hedger is None else hedger.info(),
+        "leases": None if coordinator is None else coordinator.info(),
+        "tokens": tokens,
+    }
+
+
+@app.get("/admin/slow_requests")
+async def admin_slow_requests(request: Request):
+    if not is_admin(request):
+        return Response(json.dumps({"status": "Admin only"}), 403)
+    return {
+        "threshold": tracer.slow_threshold,
+        "requests": [trace.info() for trace in reversed(tracer.slow_requests)],
+    }
+
+
+@app.get("/admin/cache")
+async def admin_cache(request: Request):
+    if not is_admin(request):
+        return Response(json.dumps({"status": "Admin only"}), 403)
+    return {
+        "enabled": result_cache is not None,
+        "cache": None if result_cache is None else result_cache.info(),
+        "singleflight": {**inflight_requests.stats, "in_flight": len(inflight_requests)},
+    }
+
+
+@app.get("/admin/queue")
+async def admin_queue(request: Request):
+    if not is_admin(request):
+        return Response(json.dumps({"status": "Admin only"}), 403)
+    return {
+        "queued": scheduler.queue_info(),
+        "pools": scheduler.pool_info(),
+        "wait": scheduler.wait_info(),
+        "aging": scheduler.aging,
+        "max_wait": scheduler.max_wait,
+        "promoted": scheduler.promoted,
+        "admission": {
+            "total": admission.total,
+            "rejected": admission.rejected,
+            "throughput": admission.throughput(),
+        },
+    }
+
+
+@app.post("/admin/reload")
+async def admin_reload(request: Request):
+    if not is_admin(request):
+        return Response(json.dumps({"status": "Admin only"}), 403)
+    try:
+        result = await reload_config()
+    except Exception as e:
+        return Response(json.dumps({"status": "Reload failed", "error": str(e)}), 400)
+    return {"status": "reloaded", **result}
+
+
+@app.post("/admin/tokens/{index}/reset")
+async def admin_reset_token(index: int, request: Request):
+    if not is_admin(request):
+        return Response(json.dumps({"status": "Admin only"}), 403)
+    if not 0 <= index < len(scheduler.clients):
+        return Response(json.dumps({"status": "Token not found"}), 404)
+    scheduler.clients[index].breaker.reset()
+    scheduler.wakeup()
+    return {"status": "reset"}
+
+
+async def reload_config() -> dict[str, Any]:
+    """
+    Re-read the config file and apply it to the running server.
+
+    Tokens are added and removed, auth entries, routes and tuning knobs take
+    effect for new requests. Queued and running requests are kept. Keys in
+    RESTART_KEYS still need a restart.
+    """
+    global server_config, auth_configs, token_list, hedger, encoder, result_cache
+    async with reload_lock:
+        new_config = toml.load(config_path)["gen_server"]
+        # Nothing is applied unless all of it can be
+        validate_config(new_config)
+        changed = diff_config(server_config, new_config)
+        if restart_keys := changed & RESTART_KEYS:
+            print(f"Config keys {sorted(restart_keys)} need a restart to apply")
+        server_config = new_config
+        auth_configs = server_config.get("auth", [])
+        tokens, token_pools = config_tokens()
+        configure_scheduler()
+        retry_list.clear()
+        retry_list.update(server_config.get("retry_status_code", []))
+        for client in nai_clients.values():
+            if client is not None:
+                configure_breaker(client.breaker)
+                client.bucket.configure(*bucket_args())
+        scheduler.limiter.configure(*limiter_args(len(tokens)))
+        configure_admission()
+        configure_tracer()
+        job_manager.result_ttl = server_config.get("job_result_ttl", 600)
+        if coordinator is not None:
+            coordinator.poll_interval = server_config.get("lease_poll_interval", 0.2)
+        if changed & {"hedge_enabled", "hedge_percentile", "hedge_budget"}:
+            hedger = make_hedger()
+        elif hedger is not None:
+            hedger.min_delay = server_config.get("hedge_min_delay", 5.0)
+
+        removed = [token for token in token_list if token not in tokens]
+        added = [
+            token
+            for token in tokens
+            if token not in nai_clients and token not in token_checks
+        ]
+        for token in removed:
+            if (check := token_checks.pop(token, None)) is not None:
+                check.cancel()
+            client = nai_clients.pop(token, None)
+            if client is None:
+                continue
+            scheduler.remove_client(client)
+            client.removed = True
+            if not client.leased:
+                await client.close()
+        for client in scheduler.clients[:]:
+            pool = token_pools.get(client.token, DEFAULT_POOL)
+            if client.pool != pool:
+                scheduler.remove_client(client)
+                scheduler.add_client(client, pool)
+        token_list = tokens
+        await asyncio.gather(*check_tokens(added), return_exceptions=True)
+
+        if changed & {"save_directly", "encode_workers", "encode_queue_size"}:
+            # Images already queued finish on the old encoder
+            old_encoder = encoder
+            encoder = save_queue.encoder = make_encoder()
+            if old_encoder is not None:
+                spawn(old_encoder.retire())
+        elif encoder is not None:
+            encoder.configure(
+                server_config.get("compression_quality", 75),
+                server_config.get("compression_method", 4),
+            )
+        save_queue.separate_metadata = server_config.get("separate_metadata", False)
+        save_queue.batch_size = server_config.get("save_batch_size", 16)
+        save_queue.fsync = server_config.get("save_fsync", "none")
+        if changed & {"cache_enabled", "save_directly", "save_path"}:
+            result_cache = make_result_cache()
+        elif result_cache is not None:
+            result_cache.max_bytes = int(
+                server_config.get("cache_memory_size", 256) * 1024 * 1024
+            )
+        scheduler.wakeup()
+        print(
+            f"Reloaded config: {len(changed)} keys changed, "
+            f"{len(added)} tokens added, {len(removed)} tokens removed"
+        )
+        return {
+            "changed": sorted(changed),
+            "added_tokens": len(added),
+            "removed_tokens": len(removed),
+        }
+
+
+def spawn(coro) -> asyncio.Task:
+    # Keep a reference so the task is not garbage collected
+    task = asyncio.ensure_future(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+
+def reload_in_background():
+    async def reload():
+        try:
+            await reload_config()
+        except Exception as e:
+            print(f"Failed to reload config: {e!r}")
+
+    spawn(reload())
+
+
+def lease_db_path(config: str, server_config: GenServerConfig) -> str:
+    """
+    Path of the token lease database, "" if this process doesn't share tokens.
+    """
+    if path := server_config.get("coordinator_path", ""):
+        return path
+    if server_config.get("workers", 1) > 1:
+        return os.path.join(os.path.dirname(os.path.abspath(config)), ".knai-leases.db")
+    return ""
+
+
+def journal_path(slot: int) -> str:
+    """
+    Path of the job journal, every worker process has its own.
+
+    Keyed by the worker's slot in run_workers rather than its coordinator id,
+    ids change when a worker restarts within lease_ttl but slots don't, so a
+    restarted worker finds the journal of its predecessor.
+    """
+    path = server_config.get("job_journal_path", "")
+    if path and server_config.get("workers", 1) > 1:
+        root, ext = os.path.splitext(path)
+        path = f"{root}-{slot}{ext}"
+    return path
+
+
+def set_session_secret(secret: str):
+    # Only possible before the app starts, the middleware stack is built then
+    for middleware in app.user_middleware:
+        if middleware.cls is SessionMiddleware:
+            middleware.kwargs["secret_key"] = secret
+
+
+async def lease_heartbeat():
+    interval = coordinator.lease_ttl / 3
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            coordinator.heartbeat(
+                [client.token for client in scheduler.clients if client.leased]
+            )
+        except Exception as e:
+            print(f"Lease heartbeat failed: {e!r}")
+
+
+async def main(
+    config: str, sockets: list[socket.socket] | None = None, slot: int = 0
+):
+    global server_config, auth_configs, retry_list
+    global scheduler, encoder, save_queue, result_cache, job_manager, admission
+    global hedger, token_list, config_path, coordinator, id_gen, peer_journals
+    config_path = config
     server_config = toml.load(config)["gen_server"]
+    validate_config(server_config)
+    if path := lease_db_path(config, server_config):
+        coordinator = LeaseCoordinator(
+            path,
+            server_config.get("lease_ttl", 30.0),
+            server_config.get("lease_poll_interval", 0.2),
+        )
+        id_gen = SnowflakeGenerator(coordinator.worker_id)
+        print(f"Worker {coordinator.worker_id} (pid {os.getpid()}) started")
     auth_configs = server_config.get("auth", [])
-    tokens = server_config.get("tokens", [])
-    token = server_config.get("token", None)
     retry_list = set(server_config.get("retry_status_code", []))
-    if token:
-        tokens.append(token)
-    if tokens:
-        for token in tokens:
-            client = await NAILocalClient.create(token)
-            if client is None:
-                print(f"Failed to create client for {token}")
-            nai_clients[token] = client
-    else:
-        raise ValueError("No token provided, please set 'tokens' in config.toml")
-    generate_semaphore = asyncio.Semaphore(
-        server_config.get("max_jobs", 0) or len(nai_clients)
+    if (secret := server_config.get("session_secret", "")) and not os.environ.get(
+        SESSION_SECRET_ENV
+    ):
+        set_session_secret(secret)
+    journal = None
+    if path := journal_path(slot):
+        journal = JobJournal(path, server_config.get("job_journal_sync", "normal"))
+    job_manager = JobManager(server_config.get("job_result_ttl", 600), journal)
+    admission = AdmissionControl()
+    configure_admission()
+    configure_tracer()
+    tokens, _ = config_tokens()
+    scheduler = TokenScheduler(
+        AIMDLimiter(*limiter_args(len(tokens))), coordinator=coordinator
+    )
+    configure_scheduler()
+    hedger = make_hedger()
+    # Check tokens concurrently while the server starts, requests queue until
+    # tokens are live, see /healthz
+    token_list = tokens
+    check_tokens(token_list)
+    encoder = make_encoder()
+    save_queue = SaveQueue(
+        id_gen,
+        encoder,
+        server_config.get("separate_metadata", False),
+        server_config.get("save_workers", 4),
+        server_config.get("save_queue_size", 256),
+        server_config.get("save_batch_size", 16),
+        server_config.get("save_fsync", "none"),
     )
+    save_queue.start()
+    metrics.QUEUE_DEPTH.set_function(lambda: scheduler.queue_size)
+    metrics.IN_FLIGHT.set_function(lambda: scheduler.in_flight)
+    metrics.CONCURRENCY_LIMIT.set_function(lambda: scheduler.limiter.current)
+    metrics.SAVE_BACKLOG.set_function(lambda: save_queue.backlog)
+    metrics.QUEUE_WAIT_QUANTILE.set_function(
+        lambda: {
+            (priority, quantile): info[key]
+            for priority, info in scheduler.wait_info().items()
+            for quantile, key in (("0.5", "p50"), ("0.9", "p90"), ("0.99", "p99"))
+        }
+    )
+    result_cache = make_result_cache()
+    if hasattr(signal, "SIGHUP"):
+        try:
+            asyncio.get_running_loop().add_signal_handler(
+                signal.SIGHUP, reload_in_background
+            )
+        except NotImplementedError:
+            pass
+    if (watch_interval := server_config.get("config_watch_interval", 0)) > 0:
+        spawn(watch_file(config, watch_interval, reload_config))
+    if coordinator is not None:
+        spawn(lease_heartbeat())
+    if journal is not None:
+        resume_jobs()
+        if (workers := server_config.get("workers", 1)) > 1:
+            peer_journals = [journal_path(i) for i in range(workers) if i != slot]
     server = Server(
         Config(
             app=app,
             host=server_config["host"],
             port=server_config["port"],
+            # don't let open event streams hold up the shutdown
+            timeout_graceful_shutdown=server_config.get("drain_timeout", 60.0),
         )
     )
-    await server.serve()
+    # Stops accepting connections on SIGTERM/SIGINT, waits for running /gen
+    # requests and then runs `shutdown` through the lifespan
+    await server.serve(sockets)
+
+
+async def shutdown():
+    """
+    Finish jobs, flush saves and close everything.
+
+    Runs in the lifespan shutdown which uvicorn awaits inside serve(), after
+    serve() returns uvicorn re-raises SIGTERM/SIGINT so later code may not run.
+    """
+    for task in background_tasks:
+        task.cancel()
+    await job_manager.drain(server_config.get("drain_timeout", 60.0))
+    # flush pending saves before the encoder goes away
+    await save_queue.close()
+    if encoder is not None:
+        await asyncio.to_thread(encoder.shutdown)
+    tracer.flush()
+    if job_manager.journal is not None:
+        job_manager.journal.close()
+    if coordinator is not None:
+        coordinator.close()
+
+
+def worker(config: str, sock: socket.socket, slot: int):
+    asyncio.run(main(config, [sock], slot))
+
+
+def run_workers(config: str, workers: int):
+    """
+    Serve with several processes sharing one listening socket. Tokens are
+    leased through the coordinator so each one is used by one process at a
+    time.
+    """
+    server_config = toml.load(config)["gen_server"]
+    sock = Config(
+        app=app, host=server_config["host"], port=server_config["port"]
+    ).bind_socket()
+    os.environ.setdefault(
+        SESSION_SECRET_ENV, server_config.get("session_secret", "") or uuid4().hex
+    )
+    context = multiprocessing.get_context("spawn")
+    processes = [
+        context.Process(target=worker, args=(config, sock, slot))
+        for slot in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    # uvicorn in the workers shuts down gracefully on SIGTERM
+    signal.signal(
+        signal.SIGTERM, lambda *_: [process.terminate() for process in processes]
+    )
+    if hasattr(signal, "SIGHUP"):
+        # Workers reload the config, the master only forwards it
+        signal.signal(
+            signal.SIGHUP,
+            lambda *_: [os.kill(process.pid, signal.SIGHUP) for process in processes],
+        )
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        # Workers got the signal too and shut down by themselves
+        for process in processes:
+            process.join()
+    finally:
+        sock.close()
 
 
 @click.command()
@@ -325,8 +1533,15 @@ async def main(config: str):
     type=click.Path(exists=True),
 )
 def runner(config: str):
-    asyncio.run(main(config))
+    workers = toml.load(config)["gen_server"].get("workers", 1)
+    if workers > 1:
+        run_workers(config, workers)
+    else:
+        asyncio.run(main(config))
 
 
 if __name__ == "__main__":
+    # Encoder and worker processes are spawned, a frozen server.exe must not
+    # run the CLI again in them
+    multiprocessing.freeze_support()
     runner()
@@ -0,0 +1,90 @@
+import math
+import time
+from collections import Counter, deque
+from typing import Hashable
+
+
+class AdmissionControl:
+    """
+    Limit the number of outstanding (queued or running) requests.
+
+    Limits are checked on arrival, overall, per session and per priority, 0
+    means unlimited. Rejected callers get a retry-after estimated from the
+    recent generation throughput, so they can back off instead of piling up.
+    """
+
+    def __init__(
+        self,
+        max_total: int = 0,
+        max_per_session: int = 0,
+        max_per_priority: dict[int, int] | None = None,
+        window: int = 50,
+        default_retry_after: int = 10,
+    ):
+        self.max_total = max_total
+        self.max_per_session = max_per_session
+        self.max_per_priority = max_per_priority or {}
+        self.default_retry_after = default_retry_after
+        self.total = 0
+        self.per_session: Counter[Hashable] = Counter()
+        self.per_priority: Counter[int] = Counter()
+        self.completions: deque[float] = deque(maxlen=window)
+        self.rejected = 0
+
+    def throughput(self) -> float:
+        """Finished generations per second, 0 if unknown."""
+        if len(self.completions) < 2:
+            return 0.0
+        # Measure until now so the estimate decays when nothing finishes
+        elapsed = time.time() - self.completions[0]
+        if elapsed <= 0:
+            return 0.0
+        return (len(self.completions) - 1) / elapsed
+
+    def estimate_wait(self, position: int) -> float | None:
+        """Seconds until a request with `position` requests ahead starts."""
+        throughput = self.throughput()
+        if not throughput:
+            return None
+        return (position + 1) / throughput
+
+    def try_admit(self, session: Hashable, priority: int) -> int | None:
+        """
+        Admit a request. Return None if admitted, otherwise seconds to wait
+        before retrying (whole seconds, as Retry-After requires).
+        """
+        overflow = 0
+        if self.max_total:
+            overflow = max(overflow, self.total - self.max_total + 1)
+        if self.max_per_session:
+            overflow = max(
+                overflow, self.per_session[session] - self.max_per_session + 1
+            )
+        if (limit := self.max_per_priority.get(priority, 0)):
+            overflow = max(overflow, self.per_priority[priority] - limit + 1)
+        if overflow > 0:
+            self.rejected += 1
+            wait = self.estimate_wait(overflow - 1)
+            if wait is None:
+                wait = self.default_retry_after
+            return max(math.ceil(wait), 1)
+        self.add(session, priority)
+        return None
+
+    def add(self, session: Hashable, priority: int):
+        """Count a request without checking the limits (e.g. resumed jobs)."""
+        self.total += 1
+        self.per_session[session] += 1
+        self.per_priority[priority] += 1
+
+    def release(self, session: Hashable, priority: int):
+        self.total -= 1
+        self.per_session[session] -= 1
+        if self.per_session[session] <= 0:
+            del self.per_session[session]
+        self.per_priority[priority] -= 1
+        if self.per_priority[priority] <= 0:
+            del self.per_priority[priority]
+
+    def record_completion(self):
+        self.completions.append(time.time())
@@ -0,0 +1,114 @@
+import random
+import time
+from typing import Any
+
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+QUARANTINED = "quarantined"
+
+AUTH_STATUS_CODES = {401, 402, 403}
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker of one NAI token.
+
+    closed: token is healthy.
+    open: token failed `failure_threshold` times in a row, it is not used until
+        the cooldown ends. Cooldown is `base_delay * 2 ** (opens - 1)` capped by
+        `max_delay`, with jitter so tokens don't come back at the same moment.
+    half-open: cooldown ended, the next request is a probe. Success closes the
+        breaker, failure opens it again with a longer cooldown.
+    quarantined: token failed auth `quarantine_after` times in a row, it is
+        never used again until reset.
+    """
+
+    def __init__(
+        self,
+        base_delay: float = 5.0,
+        max_delay: float = 300.0,
+        failure_threshold: int = 1,
+        quarantine_after: int = 3,
+        retry_status_codes: set[int] | None = None,
+    ):
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.failure_threshold = failure_threshold
+        self.quarantine_after = quarantine_after
+        self.retry_status_codes = retry_status_codes or set()
+        self.reset()
+
+    def reset(self):
+        self.state = CLOSED
+        self.failures = 0
+        self.auth_failures = 0
+        self.opens = 0
+        self.open_until = 0.0
+        self.last_status: int | None = None
+        self.last_failure_time = 0.0
+
+    def available(self, now: float) -> bool:
+        if self.state == OPEN and now >= self.open_until:
+            self.state = HALF_OPEN
+        return self.state in {CLOSED, HALF_OPEN}
+
+    @property
+    def retry_at(self) -> float:
+        """Earliest time the token can be used again."""
+        if self.state == QUARANTINED:
+            return float("inf")
+        if self.state == OPEN:
+            return self.open_until
+        return 0.0
+
+    def record_success(self):
+        self.state = CLOSED
+        self.failures = 0
+        self.auth_failures = 0
+        self.opens = 0
+
+    def record_failure(self, status_code: int | None):
+        """
+        Record a failed request. Client errors which are not the token's fault
+        (e.g. invalid parameters) are ignored.
+        """
+        now = time.time()
+        self.last_status = status_code
+        self.last_failure_time = now
+        if status_code in AUTH_STATUS_CODES:
+            self.auth_failures += 1
+            if self.auth_failures >= self.quarantine_after:
+                self.state = QUARANTINED
+                return
+        elif (
+            status_code is not None
+            and 400 <= status_code < 500
+            and status_code not in self.retry_status_codes
+        ):
+            return
+
+        self.failures += 1
+        if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+            self.opens += 1
+            delay = min(self.max_delay, self.base_delay * 2 ** (self.opens - 1))
+            # "equal jitter": keep at least half of the backoff
+            delay = delay / 2 + random.random() * delay / 2
+            self.state = OPEN
+            self.open_until = now + delay
+
+    def info(self) -> dict[str, Any]:
+        return {
+            "state": self.state,
+            "failures": self.failures,
+            "auth_failures": self.auth_failures,
+            "opens": self.opens,
+            "retry_in": (
+                None
+                if self.state == QUARANTINED
+                else max(self.retry_at - time.time(), 0)
+            ),
+            "last_status": self.last_status,
+            "last_failure_time": self.last_failure_time,
+        }
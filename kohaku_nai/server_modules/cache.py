@@ -0,0 +1,152 @@
+import asyncio
+import json
+import os
+from collections import OrderedDict
+from hashlib import sha3_256
+from typing import Any
+
+from kohaku_nai.server_modules.metrics import CACHE_REQUESTS
+
+
+def payload_key(payload: dict[str, Any]) -> str:
+    """
+    Hash of the canonical form of a NAI payload.
+    """
+    canonical = json.dumps(
+        payload, sort_keys=True, ensure_ascii=False, separators=(",", ":")
+    )
+    return sha3_256(canonical.encode("utf-8")).hexdigest()
+
+
+class ResultCache:
+    """
+    Cache of generated images keyed by `payload_key`.
+
+    Memory tier: LRU bounded by the total size of cached images.
+    Disk tier: maps keys to images which are already saved by the save queue,
+    only used when images are saved without re-encoding (save_directly) since
+    webp files are not the bytes NAI returned. The index is an append-only
+    jsonl file so it survives restarts.
+
+    `claim_save` tracks the folders the images of a key were saved to, so a
+    hit for another folder still saves a copy there.
+    """
+
+    def __init__(self, max_bytes: int, index_path: str = ""):
+        self.max_bytes = max_bytes
+        self.memory: OrderedDict[str, list[bytes]] = OrderedDict()
+        self.memory_bytes = 0
+        self.index_path = index_path
+        self.disk: dict[str, list[str]] = {}
+        self.saved: dict[str, set[str]] = {}
+        self.stats = {
+            "memory_hits": 0,
+            "disk_hits": 0,
+            "misses": 0,
+            "bypass": 0,
+        }
+        if index_path and os.path.isfile(index_path):
+            self._load_index()
+
+    def _load_index(self):
+        with open(self.index_path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    key, paths = json.loads(line)
+                except (json.JSONDecodeError, ValueError):
+                    continue
+                self.disk[key] = paths
+
+    async def get(self, key: str) -> list[bytes] | None:
+        if (images := self.memory.get(key)) is not None:
+            self.memory.move_to_end(key)
+            self._count("memory_hits", "memory_hit")
+            return images
+        if (paths := self.disk.get(key)) is not None:
+            try:
+                images = await asyncio.to_thread(_read_files, paths)
+            except OSError:
+                # Removed by user, forget it
+                self.disk.pop(key, None)
+            else:
+                self._count("disk_hits", "disk_hit")
+                self.put(key, images)
+                return images
+        self._count("misses", "miss")
+        return None
+
+    def bypass(self):
+        """Count a lookup skipped by the request (no_cache)."""
+        self._count("bypass", "bypass")
+
+    def _count(self, stat: str, result: str):
+        self.stats[stat] += 1
+        CACHE_REQUESTS.inc(result)
+
+    def put(self, key: str, images: list[bytes]):
+        size = sum(len(image) for image in images)
+        if size > self.max_bytes:
+            return
+        if (old := self.memory.pop(key, None)) is not None:
+            self.memory_bytes -= sum(len(image) for image in old)
+        self.memory[key] = images
+        self.memory_bytes += size
+        while self.memory_bytes > self.max_bytes:
+            evicted_key, evicted = self.memory.popitem(last=False)
+            self.memory_bytes -= sum(len(image) for image in evicted)
+            self.saved.pop(evicted_key, None)
+
+    def claim_save(self, key: str, folder: str) -> bool:
+        """
+        Record that the images of `key` are saved to `folder`, return False if
+        they already are.
+        """
+        if key not in self.memory and key not in self.disk:
+            # Not cached (too large), nothing to track
+            return True
+        folder = os.path.normpath(folder)
+        folders = self.saved.setdefault(key, set())
+        if (paths := self.disk.get(key)) is not None:
+            folders.add(os.path.dirname(os.path.normpath(paths[0])))
+        if folder in folders:
+            return False
+        folders.add(folder)
+        return True
+
+    def record_disk(self, key: str, paths_future: asyncio.Future):
+        """
+        Record the paths of saved images once the save queue wrote them.
+        Meant to be used as a done callback of the gathered futures from
+        `SaveQueue.put`.
+        """
+        if not self.index_path or paths_future.cancelled():
+            return
+        paths = paths_future.result()
+        if None in paths or key in self.disk:
+            return
+        self.disk[key] = paths
+        line = json.dumps([key, paths], ensure_ascii=False) + "\n"
+        asyncio.get_running_loop().run_in_executor(
+            None, _append_line, self.index_path, line
+        )
+
+    def info(self) -> dict[str, Any]:
+        return {
+            **self.stats,
+            "memory_entries": len(self.memory),
+            "memory_bytes": self.memory_bytes,
+            "disk_entries": len(self.disk),
+        }
+
+
+def _read_files(paths: list[str]) -> list[bytes]:
+    images = []
+    for path in paths:
+        with open(path, "rb") as f:
+            images.append(f.read())
+    return images
+
+
+def _append_line(path: str, line: str):
+    with open(path, "a", encoding="utf-8") as f:
+        f.write(line)
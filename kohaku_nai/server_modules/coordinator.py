@@ -0,0 +1,185 @@
+import itertools
+import os
+import sqlite3
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from hashlib import sha256
+from typing import Any, Callable
+
+
+# Snowflake worker ids are 10 bits
+MAX_WORKER_ID = 1023
+
+
+class LeaseCoordinator:
+    """
+    Token leases shared between server processes through a SQLite database.
+
+    Every process keeps its own scheduler, a token is only handed to a request
+    after its lease row is taken here, so no two processes use a token at the
+    same time. Leases expire after `lease_ttl` seconds unless renewed by
+    `heartbeat`, which frees the tokens of a crashed process.
+
+    Each process also claims a unique worker id (for its snowflake ids) in
+    [1, MAX_WORKER_ID], ids of processes which stopped heartbeating are reused.
+
+    Tokens are stored as hashes, the database never contains a full token.
+
+    `try_lease` runs on the event loop and never waits for the database lock,
+    a locked database counts as contention and the request checks again after
+    `poll_interval`. Releases and heartbeats are written in order on a
+    background thread, each lease has an id so a late release can't shorten a
+    newer lease of the same token.
+    """
+
+    def __init__(self, path: str, lease_ttl: float = 30.0, poll_interval: float = 0.2):
+        self.path = path
+        self.lease_ttl = lease_ttl
+        # how often a queued request re-checks tokens leased by other processes
+        self.poll_interval = poll_interval
+        # used by the writer thread (and before it starts)
+        self.db = sqlite3.connect(
+            path, timeout=5.0, isolation_level=None, check_same_thread=False
+        )
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS workers "
+            "(id INTEGER PRIMARY KEY, pid INTEGER, heartbeat REAL)"
+        )
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS leases "
+            "(token TEXT PRIMARY KEY, worker INTEGER, lease INTEGER, expires REAL)"
+        )
+        self.worker_id = self._register()
+        # used on the event loop, fails at once if the database is locked
+        self.lease_db = sqlite3.connect(path, timeout=0, isolation_level=None)
+        self.lease_db.execute("PRAGMA synchronous=NORMAL")
+        # Checkpoints sync the database, leave them to the writer
+        self.lease_db.execute("PRAGMA wal_autocheckpoint=0")
+        self.writer = ThreadPoolExecutor(1)
+        self.keys: dict[str, str] = {}
+        # id of our current lease of each token
+        self.leases: dict[str, int] = {}
+        self.lease_ids = itertools.count(1)
+        self.contended = 0
+        self.busy = 0
+
+    def _register(self) -> int:
+        now = time.time()
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            stale = now - self.lease_ttl
+            self.db.execute("DELETE FROM workers WHERE heartbeat < ?", (stale,))
+            used = {row[0] for row in self.db.execute("SELECT id FROM workers")}
+            free = [i for i in range(1, MAX_WORKER_ID + 1) if i not in used]
+            if not free:
+                raise RuntimeError("No free worker id, too many server processes")
+            worker_id = free[0]
+            self.db.execute(
+                "INSERT INTO workers VALUES (?, ?, ?)", (worker_id, os.getpid(), now)
+            )
+            # Leases of a previous process with this id are not ours
+            self.db.execute("DELETE FROM leases WHERE worker = ?", (worker_id,))
+            self.db.execute("COMMIT")
+        except BaseException:
+            self.db.execute("ROLLBACK")
+            raise
+        return worker_id
+
+    def _key(self, token: str) -> str:
+        if (key := self.keys.get(token)) is None:
+            key = self.keys[token] = sha256(token.encode()).hexdigest()
+        return key
+
+    def _submit(self, fn: Callable[..., Any], *args: Any):
+        future = self.writer.submit(fn, *args)
+        future.add_done_callback(self._check)
+
+    def _check(self, future: Future):
+        if (error := future.exception()) is not None:
+            # Leases expire by themselves
+            print(f"Failed to update token leases: {error!r}")
+
+    def try_lease(self, token: str) -> bool:
+        """
+        Take the lease of a token unless another process holds it.
+        """
+        now = time.time()
+        lease = next(self.lease_ids)
+        try:
+            cursor = self.lease_db.execute(
+                "INSERT INTO leases VALUES (?1, ?2, ?3, ?4) "
+                "ON CONFLICT (token) DO UPDATE SET worker = ?2, lease = ?3, "
+                "expires = ?4 WHERE expires <= ?5 OR worker = ?2",
+                (self._key(token), self.worker_id, lease, now + self.lease_ttl, now),
+            )
+        except sqlite3.OperationalError as e:
+            if "locked" not in str(e):
+                print(f"Failed to lease token: {e}")
+            self.busy += 1
+            return False
+        if cursor.rowcount:
+            self.leases[token] = lease
+            return True
+        self.contended += 1
+        return False
+
+    def release(self, token: str, hold: float = 0.0):
+        """
+        Give the lease back, other processes can take it after `hold` seconds
+        (e.g. the rate limit delay of the token).
+        """
+        if (lease := self.leases.pop(token, None)) is None:
+            return
+        self._submit(
+            self.db.execute,
+            "UPDATE leases SET expires = ? "
+            "WHERE token = ? AND worker = ? AND lease = ?",
+            (time.time() + hold, self._key(token), self.worker_id, lease),
+        )
+
+    def heartbeat(self, leased: list[str]):
+        """Keep the worker id and the leases of running requests alive."""
+        now = time.time()
+        self._submit(
+            self.db.execute,
+            "UPDATE workers SET heartbeat = ? WHERE id = ?",
+            (now, self.worker_id),
+        )
+        self._submit(
+            self.db.executemany,
+            "UPDATE leases SET expires = ? "
+            "WHERE token = ? AND worker = ? AND lease = ?",
+            [
+                (now + self.lease_ttl, self._key(token), self.worker_id, lease)
+                for token in leased
+                if (lease := self.leases.get(token)) is not None
+            ],
+        )
+
+    def info(self) -> dict[str, Any]:
+        now = time.time()
+        workers = self.lease_db.execute(
+            "SELECT COUNT(*) FROM workers WHERE heartbeat >= ?", (now - self.lease_ttl,)
+        ).fetchone()[0]
+        leased = self.lease_db.execute(
+            "SELECT COUNT(*) FROM leases WHERE expires > ?", (now,)
+        ).fetchone()[0]
+        return {
+            "worker_id": self.worker_id,
+            "workers": workers,
+            "leased_tokens": leased,
+            "contended": self.contended,
+            "busy": self.busy,
+        }
+
+    def close(self):
+        """Wait for pending writes, drop our worker id and leases."""
+        self.writer.shutdown(wait=True)
+        try:
+            self.db.execute("DELETE FROM leases WHERE worker = ?", (self.worker_id,))
+            self.db.execute("DELETE FROM workers WHERE id = ?", (self.worker_id,))
+        finally:
+            self.lease_db.close()
+            self.db.close()
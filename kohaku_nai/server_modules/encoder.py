@@ -0,0 +1,119 @@
+import asyncio
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+from kohaku_nai.utils import image_from_bytes, process_image_as_webp
+from kohaku_nai.server_modules.metrics import DECODE_TIME, ENCODE_TIME
+
+
+def _encode_webp_worker(shm_name: str, size: int, quality: int, method: int):
+    """
+    Runs in the pool process. Reads the png from shared memory and encodes it.
+    """
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        t0 = time.perf_counter()
+        img_pil = image_from_bytes(shm.buf[:size])
+        img_pil.load()
+        t1 = time.perf_counter()
+        webp_bytes = process_image_as_webp(img_pil, quality, method)
+        t2 = time.perf_counter()
+    finally:
+        img_pil = None
+        shm.close()
+    return webp_bytes, {"decode": t1 - t0, "encode": t2 - t1}
+
+
+class ImageEncoder:
+    """
+    Process based WebP encoding pool.
+
+    PIL decode and WebP encode are CPU bound and hold the GIL, so they run in a
+    ProcessPoolExecutor. The source image is handed to the worker through shared
+    memory so only the encoded result has to be pickled back. Workers are
+    spawned, forking the server (which runs threads by then) could deadlock.
+
+    At most `max_queue` jobs are queued or running at the same time, extra
+    callers wait here instead of piling up inside the pool.
+    """
+
+    def __init__(
+        self,
+        workers: int = 0,
+        max_queue: int = 0,
+        quality: int = 75,
+        method: int = 4,
+    ):
+        self.workers = workers or min(4, os.cpu_count() or 1)
+        self.max_queue = max_queue or self.workers * 4
+        self.configure(quality, method)
+        self.pool = ProcessPoolExecutor(
+            self.workers, mp_context=multiprocessing.get_context("spawn")
+        )
+        self.slots = asyncio.Semaphore(self.max_queue)
+        self.pending = 0
+        self.stats = {
+            "jobs": 0,
+            "errors": 0,
+            "queue_wait": 0.0,
+            "decode": 0.0,
+            "encode": 0.0,
+            "total": 0.0,
+        }
+
+    def configure(self, quality: int = 75, method: int = 4):
+        """Change the compression settings, used by jobs submitted after this."""
+        assert 0 <= quality <= 100, "Compression quality must be in [0, 100]"
+        assert 0 <= method <= 6, "Compression method must be in [0, 6]"
+        self.quality = quality
+        self.method = method
+
+    async def encode_webp(self, image: bytes) -> tuple[bytes, dict[str, float]]:
+        """
+        Encode png bytes to webp in the worker pool.
+        Return the webp bytes and the timing of each stage in seconds.
+        """
+        start = time.perf_counter()
+        self.pending += 1
+        try:
+            async with self.slots:
+                queued = time.perf_counter()
+                shm = shared_memory.SharedMemory(create=True, size=max(len(image), 1))
+                try:
+                    shm.buf[: len(image)] = image
+                    webp_bytes, timings = await asyncio.get_running_loop().run_in_executor(
+                        self.pool,
+                        _encode_webp_worker,
+                        shm.name,
+                        len(image),
+                        self.quality,
+                        self.method,
+                    )
+                finally:
+                    shm.close()
+                    shm.unlink()
+        except Exception:
+            self.stats["errors"] += 1
+            raise
+        finally:
+            self.pending -= 1
+        timings["queue_wait"] = queued - start
+        timings["total"] = time.perf_counter() - start
+        self.stats["jobs"] += 1
+        DECODE_TIME.observe(timings["decode"])
+        ENCODE_TIME.observe(timings["encode"])
+        for key, value in timings.items():
+            self.stats[key] += value
+        return webp_bytes, timings
+
+    def shutdown(self):
+        self.pool.shutdown(wait=True, cancel_futures=True)
+
+    async def retire(self):
+        """Shut down once the jobs already submitted are done."""
+        while self.pending:
+            await asyncio.sleep(0.1)
+        await asyncio.to_thread(self.shutdown)
@@ -0,0 +1,85 @@
+from collections import deque
+from typing import Any
+
+
+class RetryBudget:
+    """
+    Cap extra upstream requests to a fraction of the normal ones.
+
+    Every normal request deposits `ratio`, every extra request withdraws 1.
+    The balance is capped at `max_balance` so a long quiet period can't be
+    spent in one burst.
+    """
+
+    def __init__(self, ratio: float = 0.1, max_balance: float = 10.0):
+        self.ratio = ratio
+        self.max_balance = max_balance
+        self.balance = 1.0
+        self.spent = 0
+        self.exhausted = 0
+
+    def deposit(self):
+        self.balance = min(self.max_balance, self.balance + self.ratio)
+
+    def available(self) -> bool:
+        if self.balance >= 1:
+            return True
+        self.exhausted += 1
+        return False
+
+    def withdraw(self):
+        self.balance -= 1
+        self.spent += 1
+
+    def info(self) -> dict[str, Any]:
+        return {
+            "ratio": self.ratio,
+            "balance": self.balance,
+            "spent": self.spent,
+            "exhausted": self.exhausted,
+        }
+
+
+class Hedger:
+    """
+    Decide when a slow upstream request gets a duplicate on another token.
+
+    A request is hedged once it runs longer than the `percentile` of recent
+    successful latencies (at least `min_delay` seconds). Nothing is hedged until
+    `min_samples` latencies are known.
+    """
+
+    def __init__(
+        self,
+        percentile: float = 0.95,
+        min_delay: float = 5.0,
+        budget_ratio: float = 0.1,
+        window: int = 200,
+        min_samples: int = 20,
+    ):
+        assert 0 < percentile < 1, "Hedge percentile must be in (0, 1)"
+        self.percentile = percentile
+        self.min_delay = min_delay
+        self.min_samples = min_samples
+        self.latencies: deque[float] = deque(maxlen=window)
+        self.budget = RetryBudget(budget_ratio)
+        self.stats = {"hedged": 0, "hedge_won": 0, "primary_won": 0}
+
+    def record(self, latency: float):
+        self.latencies.append(latency)
+
+    def delay(self) -> float | None:
+        """Seconds after which to hedge, None if not enough data."""
+        if len(self.latencies) < self.min_samples:
+            return None
+        values = sorted(self.latencies)
+        index = min(int(self.percentile * len(values)), len(values) - 1)
+        return max(values[index], self.min_delay)
+
+    def info(self) -> dict[str, Any]:
+        return {
+            "delay": self.delay(),
+            "samples": len(self.latencies),
+            "budget": self.budget.info(),
+            **self.stats,
+        }
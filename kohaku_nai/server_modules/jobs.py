@@ -0,0 +1,214 @@
+import asyncio
+import json
+import time
+from typing import Any, Callable, Coroutine
+from uuid import uuid4
+
+from fastapi import Response
+
+from kohaku_nai.server_modules.journal import JobJournal
+from kohaku_nai.server_modules.scheduler import Ticket, current_ticket
+
+
+PENDING = "pending"
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+FINISHED_STATES = {DONE, FAILED, CANCELLED}
+
+
+class Job:
+    def __init__(
+        self,
+        priority: int,
+        session_id: str = "",
+        job_id: str | None = None,
+        on_status: Callable[["Job", str], None] | None = None,
+    ):
+        self.id = job_id or uuid4().hex
+        self.priority = priority
+        self.session_id = session_id
+        self.status = PENDING
+        self.created_at = time.time()
+        self.started_at: float | None = None
+        self.finished_at: float | None = None
+        self.response: Response | None = None
+        self.ticket = Ticket(self._on_ticket_change)
+        self.task: asyncio.Task | None = None
+        self.subscribers: set[asyncio.Queue] = set()
+        self.on_status = on_status
+
+    @property
+    def finished(self) -> bool:
+        return self.status in FINISHED_STATES
+
+    def _on_ticket_change(self, state: str):
+        if state == "queued":
+            self.set_status(QUEUED)
+        elif state == "leased":
+            if self.started_at is None:
+                self.started_at = time.time()
+            self.set_status(RUNNING)
+
+    def set_status(self, status: str):
+        if status == self.status:
+            return
+        self.status = status
+        if self.finished:
+            self.finished_at = time.time()
+        if self.on_status is not None:
+            self.on_status(self, status)
+        for queue in self.subscribers:
+            queue.put_nowait(status)
+
+    def subscribe(self) -> asyncio.Queue:
+        queue = asyncio.Queue()
+        queue.put_nowait(self.status)
+        self.subscribers.add(queue)
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue):
+        self.subscribers.discard(queue)
+
+    def error(self) -> Any:
+        if self.response is None or self.status != FAILED:
+            return None
+        try:
+            return json.loads(self.response.body)
+        except (json.JSONDecodeError, UnicodeDecodeError):
+            return self.response.body.decode("utf-8", "replace")
+
+
+class JobManager:
+    """
+    Keep track of generation jobs.
+
+    Every job runs in its own task with a scheduler Ticket bound to it, so the
+    status and the queue position follow the underlying scheduler requests.
+    Finished jobs are kept for `result_ttl` seconds so clients can fetch them.
+
+    With a journal, registered jobs, their status changes and responses are
+    written to it so they survive a restart (see `restore`). Jobs cancelled
+    while `draining` stay unfinished in the journal and are resumed later.
+    """
+
+    def __init__(self, result_ttl: float = 600, journal: JobJournal | None = None):
+        self.result_ttl = result_ttl
+        self.journal = journal
+        self.jobs: dict[str, Job] = {}
+        self.draining = False
+        self.compacted_at = 0.0
+
+    def get(self, job_id: str) -> Job | None:
+        return self.jobs.get(job_id)
+
+    def submit(
+        self,
+        coro: Coroutine[Any, Any, Response],
+        priority: int,
+        session_id: str = "",
+        keep: bool = True,
+        request: dict[str, Any] | None = None,
+        job_id: str | None = None,
+    ) -> Job:
+        """
+        Run `coro` as a job. If `keep` is False the job is not registered and
+        can only be awaited by the caller.
+
+        `request` is journaled to resume the job after a restart, a resumed
+        job passes its original `job_id` instead.
+        """
+        self.cleanup()
+        on_status = self._on_status if keep and self.journal is not None else None
+        job = Job(priority, session_id, job_id, on_status)
+        if on_status is not None and request is not None:
+            self.journal.add(job.id, job.created_at, priority, session_id, request)
+        # The task copies current context, bind the ticket to it
+        token = current_ticket.set(job.ticket)
+        try:
+            job.task = asyncio.create_task(self._run(job, coro))
+        finally:
+            current_ticket.reset(token)
+        if keep:
+            self.jobs[job.id] = job
+        return job
+
+    def restore(
+        self,
+        job_id: str,
+        priority: int,
+        session_id: str,
+        status: str,
+        created_at: float,
+        started_at: float | None,
+        finished_at: float,
+        response: Response | None,
+    ) -> Job:
+        """Register a job which finished before a restart."""
+        job = Job(priority, session_id, job_id)
+        job.status = status
+        job.created_at = created_at
+        job.started_at = started_at
+        job.finished_at = finished_at
+        job.response = response
+        self.jobs[job.id] = job
+        return job
+
+    def _on_status(self, job: Job, status: str):
+        if status == CANCELLED and self.draining:
+            return
+        if job.finished and job.response is not None:
+            self.journal.store_result(
+                job.id,
+                job.response.status_code,
+                job.response.media_type or "",
+                bytes(job.response.body),
+            )
+        self.journal.record(job.id, status, time.time())
+
+    async def _run(self, job: Job, coro: Coroutine[Any, Any, Response]) -> Response:
+        try:
+            job.response = await coro
+        except asyncio.CancelledError:
+            job.set_status(CANCELLED)
+            raise
+        except Exception as e:
+            print(f"Job {job.id} failed: {e}")
+            job.response = Response(
+                json.dumps({"status": "Internal error", "error-mes": str(e)}), 500
+            )
+        job.set_status(DONE if job.response.status_code == 200 else FAILED)
+        return job.response
+
+    async def drain(self, timeout: float):
+        """
+        Wait up to `timeout` seconds for registered jobs to finish, then cancel
+        the rest without marking them cancelled in the journal.
+        """
+        tasks = [
+            job.task
+            for job in self.jobs.values()
+            if job.task is not None and not job.task.done()
+        ]
+        if tasks:
+            print(f"Waiting for {len(tasks)} jobs to finish")
+            _, pending = await asyncio.wait(tasks, timeout=timeout)
+        else:
+            pending = set()
+        self.draining = True
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        if pending:
+            print(f"{len(pending)} unfinished jobs are resumed on the next start")
+
+    def cleanup(self):
+        now = time.time()
+        for job_id, job in list(self.jobs.items()):
+            if job.finished and now - job.finished_at > self.result_ttl:
+                del self.jobs[job_id]
+        if self.journal is not None and now - self.compacted_at > 60:
+            self.compacted_at = now
+            self.journal.compact(now - self.result_ttl, FINISHED_STATES)
@@ -0,0 +1,170 @@
+import json
+import sqlite3
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import Any
+
+
+SYNC_MODES = ("OFF", "NORMAL", "FULL")
+
+
+class JobJournal:
+    """
+    Append-only record of accepted jobs in a SQLite database (WAL mode).
+
+    Jobs are written once when accepted, every status change appends an event
+    and finished jobs store their response, so a restarted server can resume
+    unfinished jobs and serve the results of finished ones.
+
+    Writes run in order on a single background thread, callers never wait for
+    the disk. Finished jobs are removed by `compact` once they expire.
+    """
+
+    def __init__(self, path: str, synchronous: str = "NORMAL"):
+        synchronous = synchronous.upper()
+        assert synchronous in SYNC_MODES, f"Journal sync must be one of {SYNC_MODES}"
+        self.path = path
+        self.db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(f"PRAGMA synchronous={synchronous}")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, "
+            "created_at REAL, priority INTEGER, session TEXT, request TEXT)"
+        )
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS events (seq INTEGER PRIMARY KEY, "
+            "job TEXT, status TEXT, at REAL)"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS events_job ON events (job)")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS results (job TEXT PRIMARY KEY, "
+            "status_code INTEGER, media_type TEXT, body BLOB)"
+        )
+        self.writer = ThreadPoolExecutor(1)
+        self.errors = 0
+
+    def _submit(self, sql: str, *params: Any):
+        future = self.writer.submit(self.db.execute, sql, params)
+        future.add_done_callback(self._check)
+
+    def _check(self, future: Future):
+        if (error := future.exception()) is not None:
+            self.errors += 1
+            print(f"Failed to write job journal: {error!r}")
+
+    def add(
+        self,
+        job_id: str,
+        created_at: float,
+        priority: int,
+        session: str,
+        request: dict[str, Any],
+    ):
+        self._submit(
+            "INSERT INTO jobs VALUES (?, ?, ?, ?, ?)",
+            job_id,
+            created_at,
+            priority,
+            session,
+            json.dumps(request),
+        )
+
+    def record(self, job_id: str, status: str, at: float):
+        self._submit(
+            "INSERT INTO events (job, status, at) VALUES (?, ?, ?)", job_id, status, at
+        )
+
+    def store_result(self, job_id: str, status_code: int, media_type: str, body: bytes):
+        self._submit(
+            "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)",
+            job_id,
+            status_code,
+            media_type,
+            body,
+        )
+
+    def load(self) -> list[dict[str, Any]]:
+        """
+        Every journaled job with its latest status, start/finish time and
+        stored response (if any), oldest first.
+        """
+        # Wait for queued writes
+        self.writer.submit(lambda: None).result()
+        return list(read_entries(self.db).values())
+
+    def compact(self, finished_before: float, finished_states: set[str]):
+        """Remove jobs which finished before `finished_before`."""
+        states = ", ".join("?" * len(finished_states))
+        expired = (
+            "SELECT job FROM events GROUP BY job "
+            "HAVING MAX(at) < ? AND MAX(seq) IN "
+            f"(SELECT seq FROM events WHERE status IN ({states}))"
+        )
+        params = (finished_before, *finished_states)
+        self._submit(f"DELETE FROM results WHERE job IN ({expired})", *params)
+        self._submit(f"DELETE FROM jobs WHERE id IN ({expired})", *params)
+        self._submit(f"DELETE FROM events WHERE job IN ({expired})", *params)
+
+    def close(self):
+        """Wait for pending writes and close the database."""
+        self.writer.shutdown(wait=True)
+        self.db.close()
+
+
+def read_entries(db: sqlite3.Connection, job_id: str | None = None) -> dict[str, Any]:
+    """
+    Journaled jobs (or only `job_id`) by id with their latest status,
+    start/finish time and stored response (if any), oldest first.
+    """
+    if job_id:
+        by_id, by_job, params = "WHERE id = ?", "WHERE job = ?", (job_id,)
+    else:
+        by_id, by_job, params = "", "", ()
+    jobs = {}
+    for job_id, created_at, priority, session, request in db.execute(
+        f"SELECT * FROM jobs {by_id} ORDER BY created_at", params
+    ):
+        jobs[job_id] = {
+            "id": job_id,
+            "created_at": created_at,
+            "priority": priority,
+            "session": session,
+            "request": json.loads(request),
+            "status": None,
+            "started_at": None,
+            "finished_at": None,
+            "result": None,
+        }
+    for job_id, status, at in db.execute(
+        f"SELECT job, status, at FROM events {by_job} ORDER BY seq", params
+    ):
+        if (job := jobs.get(job_id)) is None:
+            continue
+        job["status"] = status
+        if status == "running" and job["started_at"] is None:
+            job["started_at"] = at
+        job["finished_at"] = at
+    for job_id, status_code, media_type, body in db.execute(
+        f"SELECT * FROM results {by_job}", params
+    ):
+        if (job := jobs.get(job_id)) is not None:
+            job["result"] = (status_code, media_type, body)
+    return jobs
+
+
+def lookup(path: str, job_id: str) -> dict[str, Any] | None:
+    """
+    Entry of one job in the journal of another process, None if it isn't
+    there. Blocks on the disk, the file is opened read-only.
+    """
+    try:
+        db = sqlite3.connect(f"{Path(path).resolve().as_uri()}?mode=ro", uri=True)
+    except sqlite3.OperationalError:
+        # Not created yet
+        return None
+    try:
+        return read_entries(db, job_id).get(job_id)
+    except sqlite3.OperationalError:
+        return None
+    finally:
+        db.close()
@@ -0,0 +1,83 @@
+import time
+from typing import Any
+
+
+class AIMDLimiter:
+    """
+    Adaptive concurrency limit (additive increase, multiplicative decrease).
+
+    Every healthy response (success and latency within `latency_tolerance` times
+    the average) raises the limit by `increase / limit`, so roughly by
+    `increase` per full round of in-flight requests. An overload signal (429 or
+    timeout) multiplies the limit by `decrease`, at most once per
+    `decrease_interval` seconds so a burst of 429s from one wave of requests
+    only counts once.
+    """
+
+    def __init__(
+        self,
+        max_limit: float,
+        min_limit: float = 1,
+        increase: float = 1.0,
+        decrease: float = 0.5,
+        latency_tolerance: float = 2.0,
+        decrease_interval: float = 1.0,
+    ):
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.increase = increase
+        self.decrease = decrease
+        self.latency_tolerance = latency_tolerance
+        self.decrease_interval = decrease_interval
+        self.limit = float(max_limit)
+        self.latency_avg = 0.0
+        self.last_decrease = 0.0
+
+    @property
+    def current(self) -> int:
+        return max(int(self.limit), 1)
+
+    def record(self, success: bool, latency: float, overloaded: bool):
+        if overloaded:
+            now = time.time()
+            if now - self.last_decrease >= self.decrease_interval:
+                self.limit = max(self.min_limit, self.limit * self.decrease)
+                self.last_decrease = now
+            return
+        if not success:
+            return
+        healthy = (
+            not self.latency_avg
+            or latency <= self.latency_avg * self.latency_tolerance
+        )
+        # EWMA of successful latency
+        if self.latency_avg:
+            self.latency_avg = self.latency_avg * 0.9 + latency * 0.1
+        else:
+            self.latency_avg = latency
+        if healthy:
+            self.limit = min(self.max_limit, self.limit + self.increase / self.limit)
+
+    def configure(
+        self,
+        max_limit: float,
+        min_limit: float = 1,
+        increase: float = 1.0,
+        decrease: float = 0.5,
+        latency_tolerance: float = 2.0,
+    ):
+        """Apply new settings, the current limit is clamped to the new bounds."""
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.increase = increase
+        self.decrease = decrease
+        self.latency_tolerance = latency_tolerance
+        self.limit = min(max(self.limit, min_limit), max_limit)
+
+    def info(self) -> dict[str, Any]:
+        return {
+            "limit": self.current,
+            "limit_raw": self.limit,
+            "max_limit": self.max_limit,
+            "latency_avg": self.latency_avg,
+        }
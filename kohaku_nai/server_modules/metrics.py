@@ -0,0 +1,193 @@
+"""
+Minimal prometheus style metrics.
+
+Metrics are plain dicts keyed by label values, so recording is a dict lookup and
+an addition. The text exposition format is only built when /metrics is read.
+"""
+
+from bisect import bisect_left
+from typing import Callable
+
+
+DEFAULT_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300
+)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names: tuple[str, ...], values: tuple, extra: str = "") -> str:
+    labels = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        labels.append(extra)
+    return "{" + ",".join(labels) + "}" if labels else ""
+
+
+class Metric:
+    type = ""
+
+    def __init__(self, name: str, documentation: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = labels
+        REGISTRY.append(self)
+
+    def collect(self) -> list[str]:
+        return [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.type}",
+            *self.samples(),
+        ]
+
+    def samples(self) -> list[str]:
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, name, documentation, labels=()):
+        super().__init__(name, documentation, labels)
+        self.values: dict[tuple, float] = {}
+
+    def inc(self, *labels, amount: float = 1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self):
+        return [
+            f"{self.name}{_format_labels(self.label_names, labels)} {value}"
+            for labels, value in self.values.items()
+        ]
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def __init__(self, name, documentation, labels=()):
+        super().__init__(name, documentation, labels)
+        self.values: dict[tuple, float] = {}
+        self.function: Callable[[], float | dict[tuple, float]] | None = None
+
+    def set(self, value: float, *labels):
+        self.values[labels] = value
+
+    def set_function(self, function: Callable[[], float | dict[tuple, float]]):
+        """
+        Read the value from `function` when collected.
+        Labeled gauges expect a dict of label values -> value.
+        """
+        self.function = function
+
+    def samples(self):
+        values = self.values
+        if self.function is not None:
+            try:
+                values = self.function()
+            except Exception:
+                return []
+            if not self.label_names:
+                return [f"{self.name} {float(values)}"]
+        return [
+            f"{self.name}{_format_labels(self.label_names, labels)} {value}"
+            for labels, value in values.items()
+        ]
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+        # labels -> [bucket counts..., +Inf count], sum
+        self.counts: dict[tuple, list[int]] = {}
+        self.sums: dict[tuple, float] = {}
+
+    def observe(self, value: float, *labels):
+        if (counts := self.counts.get(labels)) is None:
+            counts = self.counts[labels] = [0] * (len(self.buckets) + 1)
+            self.sums[labels] = 0.0
+        counts[bisect_left(self.buckets, value)] += 1
+        self.sums[labels] += value
+
+    def samples(self):
+        lines = []
+        for labels, counts in self.counts.items():
+            total = 0
+            for bound, count in zip((*self.buckets, "+Inf"), counts):
+                total += count
+                le = _format_labels(self.label_names, labels, f'le="{bound}"')
+                lines.append(f"{self.name}_bucket{le} {total}")
+            label_str = _format_labels(self.label_names, labels)
+            lines.append(f"{self.name}_sum{label_str} {self.sums[labels]}")
+            lines.append(f"{self.name}_count{label_str} {total}")
+        return lines
+
+
+REGISTRY: list[Metric] = []
+
+
+def generate_latest() -> str:
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.collect())
+    return "\n".join(lines) + "\n"
+
+
+QUEUE_WAIT = Histogram(
+    "knai_queue_wait_seconds",
+    "Time waiting in the scheduler for a token",
+    ("priority",),
+)
+UPSTREAM_LATENCY = Histogram(
+    "knai_upstream_latency_seconds", "Latency of NAI generate requests", ("token",)
+)
+DECODE_TIME = Histogram("knai_decode_seconds", "Time to decode generated png")
+ENCODE_TIME = Histogram("knai_encode_seconds", "Time to encode webp")
+SAVE_TIME = Histogram("knai_save_seconds", "Time to write one batch of images")
+
+UPSTREAM_REQUESTS = Counter(
+    "knai_upstream_requests_total",
+    "NAI generate requests by token and status code",
+    ("token", "status"),
+)
+UPSTREAM_RETRIES = Counter(
+    "knai_upstream_retries_total", "Retried NAI generate requests", ("token",)
+)
+UPSTREAM_ERRORS = Counter(
+    "knai_upstream_errors_total",
+    "Failed NAI generate requests by token and status code",
+    ("token", "status"),
+)
+UPSTREAM_HEDGES = Counter(
+    "knai_upstream_hedges_total",
+    "Hedged NAI requests by which copy won",
+    ("winner",),
+)
+DROPPED_REQUESTS = Counter(
+    "knai_dropped_requests_total",
+    "Requests dropped by deadline or disconnect, stage=queued never reached NAI",
+    ("reason", "stage"),
+)
+CACHE_REQUESTS = Counter(
+    "knai_cache_requests_total",
+    "Result cache lookups by result (memory_hit, disk_hit, miss, bypass)",
+    ("result",),
+)
+SINGLEFLIGHT_REQUESTS = Counter(
+    "knai_singleflight_requests_total",
+    "Fixed seed generations which started (leader) or joined (follower) a call",
+    ("role",),
+)
+
+QUEUE_DEPTH = Gauge("knai_queue_depth", "Requests waiting for a token")
+IN_FLIGHT = Gauge("knai_in_flight", "Generations running upstream")
+CONCURRENCY_LIMIT = Gauge("knai_concurrency_limit", "Current adaptive concurrency limit")
+SAVE_BACKLOG = Gauge("knai_save_backlog", "Images waiting to be saved")
+QUEUE_WAIT_QUANTILE = Gauge(
+    "knai_queue_wait_quantile_seconds",
+    "Recent queue wait percentiles per priority",
+    ("priority", "quantile"),
+)
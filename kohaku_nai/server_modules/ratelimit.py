@@ -0,0 +1,89 @@
+import random
+import time
+from typing import Any
+
+
+class TokenBucket:
+    """
+    Token bucket rate limiter of one NAI token.
+
+    Refill `rate` permits per second up to `burst`. When a request has to wait
+    for a refill, a random extra delay in [0, jitter) is added so requests of
+    one account are not spaced perfectly evenly.
+    rate <= 0 means no limit.
+
+    The rate also adapts to the upstream (AIMD): it is halved when NAI says the
+    account is overloaded and recovers additively on success, never going above
+    the configured rate or below `min_ratio` of it.
+    """
+
+    def __init__(
+        self,
+        rate: float,
+        burst: int = 1,
+        jitter: float = 0.0,
+        min_ratio: float = 0.1,
+    ):
+        self.base_rate = rate
+        self.rate = rate
+        self.min_ratio = min_ratio
+        self.burst = max(burst, 1)
+        self.jitter = jitter
+        self.permits = float(self.burst)
+        self.updated = 0.0
+        self.hold_until = 0.0
+
+    def _refill(self, now: float):
+        if self.updated:
+            self.permits = min(
+                self.burst, self.permits + (now - self.updated) * self.rate
+            )
+        self.updated = now
+
+    def ready_at(self, now: float) -> float:
+        """Earliest time a request can be made."""
+        if self.rate <= 0:
+            return now
+        self._refill(now)
+        if self.permits >= 1:
+            return max(now, self.hold_until)
+        return max(now + (1 - self.permits) / self.rate, self.hold_until)
+
+    def take(self, now: float):
+        if self.rate <= 0:
+            return
+        self._refill(now)
+        self.permits -= 1
+        if self.permits < 1:
+            # bucket is empty, next request waits for refill + jitter
+            refill_at = now + (1 - self.permits) / self.rate
+            self.hold_until = refill_at + random.random() * self.jitter
+
+    def configure(self, rate: float, burst: int = 1, jitter: float = 0.0):
+        """Apply new settings, an adapted rate keeps its ratio to the base."""
+        if rate > 0 and self.base_rate > 0:
+            self.rate = rate * self.rate / self.base_rate
+        else:
+            self.rate = rate
+        self.base_rate = rate
+        self.burst = max(burst, 1)
+        self.permits = min(self.permits, self.burst)
+        self.jitter = jitter
+
+    def record(self, success: bool, overloaded: bool):
+        if self.base_rate <= 0:
+            return
+        if overloaded:
+            self._refill(time.time())
+            self.rate = max(self.base_rate * self.min_ratio, self.rate * 0.5)
+        elif success and self.rate < self.base_rate:
+            self._refill(time.time())
+            self.rate = min(self.base_rate, self.rate + self.base_rate * 0.1)
+
+    def info(self) -> dict[str, Any]:
+        return {
+            "rate": self.rate,
+            "base_rate": self.base_rate,
+            "burst": self.burst,
+            "permits": self.permits,
+        }
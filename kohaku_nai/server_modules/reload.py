@@ -0,0 +1,46 @@
+import asyncio
+import os
+from typing import Any, Awaitable, Callable
+
+
+# Settings which are only read at startup
+RESTART_KEYS = {
+    "host",
+    "port",
+    "save_workers",
+    "save_queue_size",
+    "workers",
+    "coordinator_path",
+    "lease_ttl",
+    "job_journal_path",
+    "job_journal_sync",
+    "session_secret",
+}
+
+
+def diff_config(old: dict[str, Any], new: dict[str, Any]) -> set[str]:
+    """Keys whose value differs between two config sections."""
+    return {key for key in old.keys() | new.keys() if old.get(key) != new.get(key)}
+
+
+async def watch_file(
+    path: str, interval: float, callback: Callable[[], Awaitable[Any]]
+):
+    """
+    Poll the modification time of `path` and await `callback` when it changes.
+    """
+    last_mtime = os.path.getmtime(path)
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            mtime = os.path.getmtime(path)
+        except OSError:
+            # The file may be replaced by an editor, check again next time
+            continue
+        if mtime == last_mtime:
+            continue
+        last_mtime = mtime
+        try:
+            await callback()
+        except Exception as e:
+            print(f"Failed to reload {path}: {e!r}")
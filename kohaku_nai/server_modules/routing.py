@@ -0,0 +1,59 @@
+from fnmatch import fnmatch
+from typing import Any
+
+from kohaku_nai.server_modules.scheduler import DEFAULT_POOL
+
+
+COST_CLASSES = ("free", "paid")
+
+
+class Route:
+    """
+    Send matching requests to `pool`. Empty conditions match everything.
+
+    models: glob patterns of the model name, e.g. "nai-diffusion-4-*"
+    cost: "free" for requests which pass free_check, "paid" for the others
+    groups: auth groups of the request (`group` of the auth entry)
+    """
+
+    def __init__(
+        self,
+        pool: str,
+        models: list[str] | None = None,
+        cost: str = "",
+        groups: list[str] | None = None,
+    ):
+        assert not cost or cost in COST_CLASSES, f"cost must be one of {COST_CLASSES}"
+        self.pool = pool
+        self.models = models or []
+        self.cost = cost
+        self.groups = set(groups or [])
+
+    def match(self, model: str, cost: str, group: str) -> bool:
+        if self.models and not any(fnmatch(model, pattern) for pattern in self.models):
+            return False
+        if self.cost and cost != self.cost:
+            return False
+        if self.groups and group not in self.groups:
+            return False
+        return True
+
+
+class Router:
+    """
+    Pick the token pool of a request, first matching route wins.
+    """
+
+    def __init__(self, routes: list[dict[str, Any]], default_pool: str = DEFAULT_POOL):
+        self.routes = [Route(**route) for route in routes]
+        self.default_pool = default_pool
+
+    @property
+    def pools(self) -> set[str]:
+        return {route.pool for route in self.routes} | {self.default_pool}
+
+    def route(self, model: str, cost: str, group: str) -> str:
+        for route in self.routes:
+            if route.match(model, cost, group):
+                return route.pool
+        return self.default_pool
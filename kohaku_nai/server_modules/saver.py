@@ -0,0 +1,252 @@
+import asyncio
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import sha3_256
+from typing import Any
+
+from snowflake import SnowflakeGenerator
+
+from kohaku_nai.server_modules.encoder import ImageEncoder
+from kohaku_nai.server_modules.metrics import SAVE_TIME
+from kohaku_nai.server_modules.tracing import current_trace
+
+
+FSYNC_POLICIES = ("none", "file", "full")
+METADATA_DIR = "metadatas"
+
+
+class SaveJob:
+    __slots__ = (
+        "save_path",
+        "sub_folder",
+        "image",
+        "metadata",
+        "img_id",
+        "future",
+        "trace",
+    )
+
+    def __init__(self, save_path, sub_folder, image, metadata, img_id, future):
+        self.save_path = save_path
+        self.sub_folder = sub_folder
+        self.image = image
+        self.metadata = metadata
+        self.img_id = img_id
+        self.future = future
+        # trace of the request which produced this image
+        self.trace = current_trace.get()
+
+
+class SaveQueue:
+    """
+    Bounded write-behind queue for generated images.
+
+    `put` returns as soon as the job is queued, encoding and disk writes happen
+    in background workers. When the queue is full `put` waits, so a slow disk
+    throttles producers instead of growing memory without bound.
+
+    Workers take up to `batch_size` jobs at once, create the directories of the
+    whole batch once and write all files in a single thread pool call.
+
+    fsync policy:
+        none: leave it to the OS
+        file: fsync every written file
+        full: fsync every written file and its directory
+    """
+
+    def __init__(
+        self,
+        id_gen: SnowflakeGenerator,
+        encoder: ImageEncoder | None = None,
+        separate_metadata: bool = False,
+        workers: int = 4,
+        max_size: int = 256,
+        batch_size: int = 16,
+        fsync: str = "none",
+    ):
+        assert fsync in FSYNC_POLICIES, f"fsync policy must be one of {FSYNC_POLICIES}"
+        self.id_gen = id_gen
+        self.encoder = encoder
+        self.separate_metadata = separate_metadata
+        self.workers = workers
+        self.batch_size = batch_size
+        self.fsync = fsync
+        self.queue: asyncio.Queue[SaveJob] = asyncio.Queue(max_size)
+        self.write_pool = ThreadPoolExecutor(workers)
+        self.created_dirs: set[str] = set()
+        self.in_progress = 0
+        self.stats = {
+            "saved": 0,
+            "errors": 0,
+            "bytes": 0,
+            "batches": 0,
+            "write_time": 0.0,
+        }
+        self.tasks: list[asyncio.Task] = []
+        self.closed = False
+
+    @property
+    def backlog(self) -> int:
+        return self.queue.qsize() + self.in_progress
+
+    def start(self):
+        self.tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def put(
+        self,
+        save_path: str,
+        sub_folder: str,
+        image: bytes,
+        metadata: str | dict[str, Any],
+    ) -> asyncio.Future:
+        """
+        Queue an image to be saved.
+        Return a future which resolves to the saved image path (None if failed).
+        A metadata dict is only dumped to json if `separate_metadata` is set.
+        """
+        if self.closed:
+            raise RuntimeError("Save queue is closed")
+        future = asyncio.get_running_loop().create_future()
+        job = SaveJob(save_path, sub_folder, image, metadata, next(self.id_gen), future)
+        await self.queue.put(job)
+        return future
+
+    async def close(self):
+        """
+        Stop accepting jobs, flush everything queued and stop the workers.
+        """
+        self.closed = True
+        await self.queue.join()
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.write_pool.shutdown(wait=True)
+
+    async def _worker(self):
+        while True:
+            batch = [await self.queue.get()]
+            while len(batch) < self.batch_size and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            self.in_progress += len(batch)
+            try:
+                await self._process(batch)
+            except Exception as e:
+                print(f"Failed to save images: {e}")
+                self.stats["errors"] += len(batch)
+                for job in batch:
+                    if not job.future.done():
+                        job.future.set_result(None)
+            finally:
+                self.in_progress -= len(batch)
+                for _ in batch:
+                    self.queue.task_done()
+
+    async def _process(self, batch: list[SaveJob]):
+        if self.encoder is not None:
+            results = await asyncio.gather(
+                *(self.encoder.encode_webp(job.image) for job in batch),
+                return_exceptions=True,
+            )
+            images = []
+            for job, result in zip(batch, results):
+                if isinstance(result, BaseException):
+                    print(f"Failed to encode image: {result}")
+                    images.append(None)
+                    continue
+                images.append(result[0])
+                if job.trace is not None:
+                    timings = result[1]
+                    end = time.time()
+                    job.trace.add_span(
+                        "encode",
+                        end - timings["total"],
+                        end,
+                        **{k: round(v, 6) for k, v in timings.items()},
+                    )
+            extension = "webp"
+        else:
+            images = [job.image for job in batch]
+            extension = "png"
+
+        t0 = time.perf_counter()
+        start_time = time.time()
+        paths = await asyncio.get_running_loop().run_in_executor(
+            self.write_pool, self._write_batch, batch, images, extension
+        )
+        write_time = time.perf_counter() - t0
+        for job in batch:
+            if job.trace is not None:
+                job.trace.add_span(
+                    "save", start_time, time.time(), batch_size=len(batch)
+                )
+        self.stats["write_time"] += write_time
+        SAVE_TIME.observe(write_time)
+        self.stats["batches"] += 1
+
+        for job, path in zip(batch, paths):
+            if path is None:
+                self.stats["errors"] += 1
+            job.future.set_result(path)
+
+    def _write_batch(
+        self, batch: list[SaveJob], images: list[bytes | None], extension: str
+    ) -> list[str | None]:
+        dirs = set()
+        for job in batch:
+            sub_folder_path = os.path.join(job.save_path, job.sub_folder)
+            dirs.add(sub_folder_path)
+            if self.separate_metadata:
+                dirs.add(os.path.join(sub_folder_path, METADATA_DIR))
+        for folder in dirs - self.created_dirs:
+            os.makedirs(folder, exist_ok=True)
+            self.created_dirs.add(folder)
+
+        paths = []
+        for job, image in zip(batch, images):
+            if image is None:
+                paths.append(None)
+                continue
+            try:
+                paths.append(self._write_one(job, image, extension))
+            except OSError as e:
+                print(f"Failed to save image: {e}")
+                # The folder may have been removed under us
+                self.created_dirs.discard(os.path.join(job.save_path, job.sub_folder))
+                paths.append(None)
+
+        if self.fsync == "full" and hasattr(os, "O_DIRECTORY"):
+            for folder in dirs:
+                fd = os.open(folder, os.O_RDONLY | os.O_DIRECTORY)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+        return paths
+
+    def _write_one(self, job: SaveJob, image: bytes, extension: str) -> str:
+        sub_folder_path = os.path.join(job.save_path, job.sub_folder)
+        img_hash = sha3_256(image).hexdigest()
+        img_name = f"{job.img_id}_{img_hash[:8]}"
+        img_path = os.path.join(sub_folder_path, f"{img_name}.{extension}")
+
+        self._write_file(img_path, image)
+        if self.separate_metadata:
+            metadata = job.metadata
+            if not isinstance(metadata, str):
+                metadata = json.dumps(metadata, ensure_ascii=False, indent=2)
+            self._write_file(
+                os.path.join(sub_folder_path, METADATA_DIR, f"{img_name}.json"),
+                metadata.encode("utf-8"),
+            )
+        self.stats["saved"] += 1
+        self.stats["bytes"] += len(image)
+        return img_path
+
+    def _write_file(self, path: str, data: bytes):
+        with open(path, "wb") as f:
+            f.write(data)
+            if self.fsync != "none":
+                f.flush()
+                os.fsync(f.fileno())
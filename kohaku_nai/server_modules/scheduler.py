@@ -0,0 +1,515 @@
+import asyncio
+import heapq
+import time
+from collections import deque
+from contextvars import ContextVar
+from itertools import count
+from typing import Any, Callable
+
+from kohaku_nai.server_modules.limiter import AIMDLimiter
+from kohaku_nai.server_modules.selection import select_first
+
+
+DEFAULT_POOL = "default"
+
+
+class Waiter:
+    """
+    Heap entry of a queued request, ordered by `key` then arrival.
+    """
+
+    __slots__ = (
+        "key",
+        "priority",
+        "group",
+        "enqueued_at",
+        "seq",
+        "future",
+        "promote_timer",
+    )
+
+    def __init__(
+        self,
+        key: float,
+        priority: int,
+        group: "Group",
+        enqueued_at: float,
+        seq: int,
+    ):
+        self.key = key
+        self.priority = priority
+        self.group = group
+        self.enqueued_at = enqueued_at
+        self.seq = seq
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+        self.promote_timer: asyncio.TimerHandle | None = None
+
+    def __lt__(self, other: "Waiter") -> bool:
+        return (self.key, self.seq) < (other.key, other.seq)
+
+
+class Group:
+    """
+    Fair share group (e.g. an auth entry). Holds its own waiter heap.
+
+    `finish` is the virtual finish tag of the last dispatched request, the
+    group with the smallest max(virtual_time, finish) goes next.
+    """
+
+    __slots__ = (
+        "name",
+        "pool",
+        "share",
+        "max_concurrency",
+        "waiters",
+        "in_flight",
+        "finish",
+    )
+
+    def __init__(
+        self, name: str, pool: "Pool", share: float = 1.0, max_concurrency: int = 0
+    ):
+        assert share > 0, "Group share must be positive"
+        self.name = name
+        self.pool = pool
+        self.share = share
+        self.max_concurrency = max_concurrency
+        self.waiters: list[Waiter] = []
+        self.in_flight = 0
+        self.finish = 0.0
+
+    @property
+    def capped(self) -> bool:
+        return 0 < self.max_concurrency <= self.in_flight
+
+    def head(self) -> Waiter | None:
+        """First waiting entry, drop cancelled ones on the way."""
+        while self.waiters and self.waiters[0].future.done():
+            heapq.heappop(self.waiters)
+        return self.waiters[0] if self.waiters else None
+
+    def info(self) -> dict[str, Any]:
+        return {
+            "share": self.share,
+            "max_concurrency": self.max_concurrency,
+            "in_flight": self.in_flight,
+            "queued": sum(1 for entry in self.waiters if not entry.future.done()),
+        }
+
+
+class Pool:
+    """
+    Named set of tokens with its own fair share queue.
+
+    When none of its tokens is usable, a pool borrows tokens of its `spillover`
+    pools as long as those have no dispatchable request of their own.
+    """
+
+    __slots__ = ("name", "spillover", "clients", "groups", "virtual_time")
+
+    def __init__(self, name: str, spillover: list[str] | None = None):
+        self.name = name
+        self.spillover = spillover or []
+        self.clients: list[Any] = []
+        self.groups: dict[str, Group] = {}
+        self.virtual_time = 0.0
+
+    def pick_group(self) -> Group | None:
+        """
+        Group to serve next: promoted waiters first, then the smallest start tag.
+        """
+        best = None
+        best_key = None
+        for group in self.groups.values():
+            if group.capped or (head := group.head()) is None:
+                continue
+            key = (
+                head.key != float("-inf"),
+                max(self.virtual_time, group.finish),
+                head.seq,
+            )
+            if best_key is None or key < best_key:
+                best, best_key = group, key
+        return best
+
+    def info(self) -> dict[str, Any]:
+        return {
+            "tokens": len(self.clients),
+            "spillover": self.spillover,
+            "groups": {name: group.info() for name, group in self.groups.items()},
+        }
+
+
+def percentile(sorted_values: list[float], q: float) -> float:
+    index = min(int(q * len(sorted_values)), len(sorted_values) - 1)
+    return sorted_values[index]
+
+
+class Ticket:
+    """
+    Follows the scheduler requests made inside one context (e.g. a job).
+    `entry` is the Waiter while waiting, None otherwise.
+    `on_change` is called with "queued" or "leased".
+    """
+
+    def __init__(self, on_change: Callable[[str], None] | None = None):
+        self.entry = None
+        self.on_change = on_change
+
+    def _notify(self, state: str):
+        if self.on_change is not None:
+            self.on_change(state)
+
+
+current_ticket: ContextVar[Ticket | None] = ContextVar("current_ticket", default=None)
+
+
+class TokenScheduler:
+    """
+    Event driven dispatcher which hands free NAI tokens to queued requests.
+
+    Tokens are split in pools (see Pool), requests wait in the pool they are
+    routed to. Inside a pool waiters are kept in one heap per fair share group,
+    ordered by effective priority, then arrival. A waiter is only woken when a
+    token is released or when the error cooldown of a free token expires, so
+    queued requests don't cost any CPU while they wait.
+
+    Aging: a waiter gains `aging` priority per second waited. As every waiter
+    ages at the same rate the order never changes over time, so the heap key is
+    simply `aging * enqueued_at - priority`. On top of that a waiter which has
+    waited `max_wait[priority]` seconds is promoted ahead of all non promoted
+    waiters, which bounds the wait of low priority classes.
+
+    Fair share: groups of a pool are served by start-time fair queueing. Every dispatch
+    advances the group's finish tag by 1 / share, so backlogged groups get
+    tokens in proportion to their share whatever their request rate, and a
+    group never has more than `max_concurrency` requests running. Idle groups
+    don't bank credit since their tag is lifted to the current virtual time.
+    Priority and aging only order requests within a group.
+
+    Clients are expected to expose `leased`, `breaker` (a CircuitBreaker),
+    `bucket` (a TokenBucket) and `stats` (a TokenStats). The number of leased
+    clients is capped by the limiter if given. Among the usable clients `select`
+    (see selection.py) picks the one to lease.
+
+    With a coordinator (see coordinator.py) tokens are shared with other
+    processes, a client is only leased once the coordinator grants its
+    `token`. Tokens held elsewhere are polled every `poll_interval`.
+    """
+
+    def __init__(
+        self,
+        limiter: AIMDLimiter | None = None,
+        aging: float = 0.0,
+        max_wait: dict[int, float] | None = None,
+        wait_window: int = 1000,
+        select: Callable[[list[Any]], Any] = select_first,
+        coordinator: Any = None,
+    ):
+        self.limiter = limiter
+        self.select = select
+        self.coordinator = coordinator
+        self.aging = aging
+        self.max_wait = max_wait or {}
+        self.in_flight = 0
+        self.clients: list[Any] = []
+        self.pools: dict[str, Pool] = {}
+        # name -> (share, max_concurrency), other groups are dropped when idle
+        self.group_settings: dict[str, tuple[float, int]] = {}
+        # client -> group it is leased to
+        self.leases: dict[Any, Group] = {}
+        self.promoted = 0
+        self.wait_window = wait_window
+        # priority -> recent queue waits in seconds
+        self.wait_times: dict[int, deque[float]] = {}
+        self._seq = count()
+        self._timer: asyncio.TimerHandle | None = None
+        self._timer_deadline = float("inf")
+
+    @property
+    def queue_size(self) -> int:
+        return sum(
+            len(group.waiters)
+            for pool in self.pools.values()
+            for group in pool.groups.values()
+        )
+
+    def set_group(self, name: str, share: float = 1.0, max_concurrency: int = 0):
+        """Set share and concurrency cap of a group (in every pool)."""
+        assert share > 0, "Group share must be positive"
+        self.group_settings[name] = (share, max_concurrency)
+        for pool in self.pools.values():
+            if (group := pool.groups.get(name)) is not None:
+                group.share = share
+                group.max_concurrency = max_concurrency
+        self._dispatch()
+
+    def get_pool(self, name: str) -> Pool:
+        if (pool := self.pools.get(name)) is None:
+            pool = self.pools[name] = Pool(name)
+        return pool
+
+    def set_pool(self, name: str, spillover: list[str] | None = None):
+        self.get_pool(name).spillover = list(spillover or [])
+        self._dispatch()
+
+    def _get_group(self, pool: Pool, name: str) -> Group:
+        if (group := pool.groups.get(name)) is None:
+            group = pool.groups[name] = Group(
+                name, pool, *self.group_settings.get(name, ())
+            )
+        return group
+
+    def _prune(self, group: Group):
+        # An idle group has no credit to keep, its tag restarts at virtual time
+        if (
+            not group.waiters
+            and not group.in_flight
+            and group.name not in self.group_settings
+        ):
+            group.pool.groups.pop(group.name, None)
+
+    def add_client(self, client, pool: str = DEFAULT_POOL):
+        client.pool = pool
+        self.clients.append(client)
+        self.get_pool(pool).clients.append(client)
+        self._dispatch()
+
+    def remove_client(self, client):
+        """
+        Stop handing out the client. A running request on it is not affected
+        and releases it as usual.
+        """
+        if client in self.clients:
+            self.clients.remove(client)
+        pool = self.pools.get(client.pool)
+        if pool is not None and client in pool.clients:
+            pool.clients.remove(client)
+
+    def position(self, ticket: Ticket) -> int | None:
+        """
+        Estimated number of waiters served before the ticket, None if it is not
+        waiting. Other groups are counted by their share relative to ours.
+        """
+        if (entry := ticket.entry) is None:
+            return None
+        group = entry.group
+        ahead = sum(
+            1
+            for other in group.waiters
+            if other < entry and not other.future.done()
+        )
+        rounds = (ahead + 1) / group.share
+        position = ahead
+        for other_group in group.pool.groups.values():
+            if other_group is group:
+                continue
+            queued = sum(1 for other in other_group.waiters if not other.future.done())
+            position += min(queued, int(rounds * other_group.share))
+        return position
+
+    async def acquire(
+        self, priority: int = 0, group: str = "", pool: str = DEFAULT_POOL
+    ):
+        now = time.time()
+        entry = Waiter(
+            self.aging * now - priority,
+            priority,
+            self._get_group(self.get_pool(pool), group),
+            now,
+            next(self._seq),
+        )
+        waiters = entry.group.waiters
+        fut = entry.future
+        if (max_wait := self.max_wait.get(priority)) is not None:
+            entry.promote_timer = asyncio.get_running_loop().call_later(
+                max_wait, self._promote, entry
+            )
+        ticket = current_ticket.get()
+        if ticket is not None:
+            ticket.entry = entry
+            ticket._notify("queued")
+        heapq.heappush(waiters, entry)
+        self._dispatch()
+        try:
+            client = await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                # Got a client but our task is cancelled, give it back
+                self.release(fut.result())
+            else:
+                if entry in waiters:
+                    waiters.remove(entry)
+                    heapq.heapify(waiters)
+                self._prune(entry.group)
+            raise
+        finally:
+            if entry.promote_timer is not None:
+                entry.promote_timer.cancel()
+            if ticket is not None:
+                ticket.entry = None
+        wait_times = self.wait_times.get(priority)
+        if wait_times is None:
+            wait_times = self.wait_times[priority] = deque(maxlen=self.wait_window)
+        wait_times.append(time.time() - entry.enqueued_at)
+        if ticket is not None:
+            ticket._notify("leased")
+        return client
+
+    def _promote(self, entry: Waiter):
+        """Move a waiter which hit its max wait ahead of the others."""
+        entry.promote_timer = None
+        waiters = entry.group.waiters
+        if entry.future.done() or entry not in waiters:
+            return
+        # Promoted waiters stay in arrival order among themselves
+        entry.key = float("-inf")
+        heapq.heapify(waiters)
+        self.promoted += 1
+
+    def wait_info(self) -> dict[int, dict[str, float]]:
+        """Percentiles of recent queue waits per priority."""
+        info = {}
+        for priority, wait_times in sorted(self.wait_times.items()):
+            if not wait_times:
+                continue
+            values = sorted(wait_times)
+            info[priority] = {
+                "count": len(values),
+                "p50": percentile(values, 0.5),
+                "p90": percentile(values, 0.9),
+                "p99": percentile(values, 0.99),
+                "max": values[-1],
+            }
+        return info
+
+    def queue_info(self) -> dict[int, int]:
+        """Number of waiters per priority."""
+        queued: dict[int, int] = {}
+        for pool in self.pools.values():
+            for group in pool.groups.values():
+                for entry in group.waiters:
+                    if not entry.future.done():
+                        queued[entry.priority] = queued.get(entry.priority, 0) + 1
+        return queued
+
+    def pool_info(self) -> dict[str, dict[str, Any]]:
+        return {name: pool.info() for name, pool in self.pools.items()}
+
+    def wakeup(self):
+        """Re-check clients, e.g. after a breaker is reset."""
+        self._dispatch()
+
+    def release(self, client):
+        client.leased = False
+        self.in_flight -= 1
+        if self.coordinator is not None:
+            now = time.time()
+            hold = max(client.bucket.ready_at(now) - now, 0)
+            self.coordinator.release(client.token, hold)
+        if (group := self.leases.pop(client, None)) is not None:
+            group.in_flight -= 1
+            self._prune(group)
+        self._dispatch()
+
+    def _pick_client(self, pool: Pool, now: float):
+        """
+        Return a free client of the pool (or of an idle spillover pool) whose
+        breaker and rate limit allow requests, chosen by `select`. Also return
+        the earliest time a free client in cooldown will be usable.
+        """
+        retry_at = float("inf")
+        sources = [pool.clients]
+        for name in pool.spillover:
+            other = self.pools.get(name)
+            if other is not None and other.pick_group() is None:
+                sources.append(other.clients)
+        for clients in sources:
+            usable = []
+            for client in clients:
+                if client.leased:
+                    continue
+                if not client.breaker.available(now):
+                    retry_at = min(retry_at, client.breaker.retry_at)
+                    continue
+                if (ready_at := client.bucket.ready_at(now)) > now:
+                    retry_at = min(retry_at, ready_at)
+                    continue
+                usable.append(client)
+            while usable:
+                client = self.select(usable)
+                if self.coordinator is not None and not self.coordinator.try_lease(
+                    client.token
+                ):
+                    # Used by another process
+                    usable.remove(client)
+                    retry_at = min(retry_at, now + self.coordinator.poll_interval)
+                    continue
+                client.bucket.take(now)
+                client.stats.last_used = now
+                return client, retry_at
+        return None, retry_at
+
+    def _lease(self, client, group: Group):
+        start = max(group.pool.virtual_time, group.finish)
+        group.pool.virtual_time = start
+        group.finish = start + 1 / group.share
+        group.in_flight += 1
+        self.leases[client] = group
+        client.leased = True
+        self.in_flight += 1
+
+    def try_acquire(self, group: str = "", pool: str = DEFAULT_POOL):
+        """
+        Lease a usable client right away, or return None. Only succeeds when
+        no request of the pool is waiting, so it never takes a token from the
+        queue (used for hedged requests).
+        """
+        if self.limiter is not None and self.in_flight >= self.limiter.current:
+            return None
+        pool_obj = self.get_pool(pool)
+        if pool_obj.pick_group() is not None:
+            return None
+        group_obj = self._get_group(pool_obj, group)
+        if group_obj.capped:
+            return None
+        client, _ = self._pick_client(pool_obj, time.time())
+        if client is None:
+            self._prune(group_obj)
+            return None
+        self._lease(client, group_obj)
+        return client
+
+    def _dispatch(self):
+        retry_at = float("inf")
+        waiting = False
+        for pool in self.pools.values():
+            while (group := pool.pick_group()) is not None:
+                if self.limiter is not None and self.in_flight >= self.limiter.current:
+                    # Released clients will dispatch again
+                    return
+                client, client_retry_at = self._pick_client(pool, time.time())
+                retry_at = min(retry_at, client_retry_at)
+                if client is None:
+                    waiting = True
+                    break
+                entry = heapq.heappop(group.waiters)
+                self._lease(client, group)
+                entry.future.set_result(client)
+        if waiting and retry_at < float("inf"):
+            self._schedule_timer(retry_at)
+
+    def _schedule_timer(self, deadline: float):
+        if self._timer is not None:
+            if self._timer_deadline <= deadline:
+                return
+            self._timer.cancel()
+        loop = asyncio.get_running_loop()
+        delay = max(deadline - time.time(), 0)
+        self._timer_deadline = deadline
+        self._timer = loop.call_later(delay, self._on_timer)
+
+    def _on_timer(self):
+        self._timer = None
+        self._timer_deadline = float("inf")
+        self._dispatch()
@@ -0,0 +1,105 @@
+"""
+Token selection strategies.
+
+When several tokens are free the scheduler asks a strategy which one to use.
+Strategies are plain functions taking the free clients (in config order) and
+returning one of them, clients expose their TokenStats as `stats`.
+
+    first: first free token (the old behaviour, favours the first tokens)
+    lru: least recently used token, spreads work evenly
+    ewma: lowest expected time to a successful response
+    p2c: power of two choices, the better of two random free tokens by ewma
+         score. Close to ewma but avoids herding onto a single token whose
+         stats are stale.
+"""
+
+import random
+from collections import deque
+from typing import Any, Callable, Sequence
+
+
+class TokenStats:
+    """
+    Rolling latency and error statistics of one token.
+    """
+
+    def __init__(self, alpha: float = 0.2, window: int = 200):
+        self.alpha = alpha
+        self.latency_ewma = 0.0
+        self.error_ewma = 0.0
+        self.latencies: deque[float] = deque(maxlen=window)
+        self.requests = 0
+        self.errors = 0
+        self.last_used = 0.0
+
+    def record(self, latency: float, success: bool):
+        self.requests += 1
+        if success:
+            self.latencies.append(latency)
+        else:
+            self.errors += 1
+            # A fast failure must not make the token look fast
+            latency = max(latency, self.latency_ewma)
+        if self.latency_ewma:
+            self.latency_ewma += self.alpha * (latency - self.latency_ewma)
+        else:
+            self.latency_ewma = latency
+        self.error_ewma += self.alpha * ((not success) - self.error_ewma)
+
+    def score(self) -> float:
+        """
+        Expected seconds until a successful response, lower is better.
+        Untried tokens score 0 so they get measured first.
+        """
+        return self.latency_ewma / max(1 - self.error_ewma, 0.05)
+
+    def info(self) -> dict[str, Any]:
+        p95 = None
+        if self.latencies:
+            latencies = sorted(self.latencies)
+            p95 = latencies[min(int(len(latencies) * 0.95), len(latencies) - 1)]
+        return {
+            "requests": self.requests,
+            "errors": self.errors,
+            "latency_ewma": self.latency_ewma,
+            "latency_p95": p95,
+            "error_rate": self.error_ewma,
+            "last_used": self.last_used,
+        }
+
+
+def select_first(clients: Sequence[Any]) -> Any:
+    return clients[0]
+
+
+def select_lru(clients: Sequence[Any]) -> Any:
+    return min(clients, key=lambda client: client.stats.last_used)
+
+
+def select_ewma(clients: Sequence[Any]) -> Any:
+    # min keeps the first of equal scores, i.e. config order among untried ones
+    return min(clients, key=lambda client: client.stats.score())
+
+
+def select_p2c(clients: Sequence[Any]) -> Any:
+    if len(clients) == 1:
+        return clients[0]
+    a, b = random.sample(clients, 2)
+    return a if a.stats.score() <= b.stats.score() else b
+
+
+STRATEGIES: dict[str, Callable[[Sequence[Any]], Any]] = {
+    "first": select_first,
+    "lru": select_lru,
+    "ewma": select_ewma,
+    "p2c": select_p2c,
+}
+
+
+def get_strategy(name: str) -> Callable[[Sequence[Any]], Any]:
+    if name not in STRATEGIES:
+        raise ValueError(
+            f"Unknown token selection {name!r}, must be one of {list(STRATEGIES)}"
+        )
+    return STRATEGIES[name]
+
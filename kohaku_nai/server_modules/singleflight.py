@@ -0,0 +1,65 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Hashable
+
+from kohaku_nai.server_modules.metrics import SINGLEFLIGHT_REQUESTS
+
+
+class Call:
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.waiters = 0
+        self.claimed: set[Hashable] = set()
+
+    def claim(self, item: Hashable) -> bool:
+        """
+        Return True only for the first caller claiming `item`.
+        Used to save a shared result once per save target.
+        """
+        if item in self.claimed:
+            return False
+        self.claimed.add(item)
+        return True
+
+
+class SingleFlight:
+    """
+    Deduplicate concurrent calls with the same key.
+
+    The first caller starts the work in its own task, later callers with the same
+    key attach to it and get the same result. The task is only cancelled when
+    every caller waiting on it is gone.
+    """
+
+    def __init__(self):
+        self.calls: dict[Hashable, Call] = {}
+        self.stats = {"leaders": 0, "followers": 0}
+
+    def __len__(self):
+        return len(self.calls)
+
+    async def do(
+        self, key: Hashable, func: Callable[[], Awaitable[Any]]
+    ) -> tuple[Any, Call]:
+        call = self.calls.get(key)
+        if call is None:
+            call = Call(asyncio.create_task(func()))
+            self.calls[key] = call
+            call.task.add_done_callback(lambda _: self._forget(key, call))
+            self.stats["leaders"] += 1
+            SINGLEFLIGHT_REQUESTS.inc("leader")
+        else:
+            self.stats["followers"] += 1
+            SINGLEFLIGHT_REQUESTS.inc("follower")
+
+        call.waiters += 1
+        try:
+            return await asyncio.shield(call.task), call
+        finally:
+            call.waiters -= 1
+            if call.waiters == 0 and not call.task.done():
+                call.task.cancel()
+                self._forget(key, call)
+
+    def _forget(self, key: Hashable, call: Call):
+        if self.calls.get(key) is call:
+            del self.calls[key]
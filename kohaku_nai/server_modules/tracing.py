@@ -0,0 +1,187 @@
+"""
+Lightweight request tracing.
+
+A Trace is created for every http request by TracingMiddleware and stored in a
+ContextVar, so any code running for that request (including tasks it creates)
+can record phases with `span(name)`. Requests slower than the threshold are kept
+in a ring buffer for the admin endpoint, and finished spans can be exported to a
+jsonl file in OTLP/JSON span format.
+"""
+
+import asyncio
+import json
+import os
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any
+
+
+class Span:
+    __slots__ = ("span_id", "parent_id", "name", "start", "end", "attrs")
+
+    def __init__(self, name: str, parent_id: str = "", attrs: dict | None = None):
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.name = name
+        self.start = time.time()
+        self.end: float | None = None
+        self.attrs = attrs or {}
+
+    def info(self, origin: float) -> dict[str, Any]:
+        return {
+            "name": self.name,
+            "offset": self.start - origin,
+            "duration": None if self.end is None else self.end - self.start,
+            **self.attrs,
+        }
+
+    def otlp(self, trace_id: str) -> dict[str, Any]:
+        return {
+            "traceId": trace_id,
+            "spanId": self.span_id,
+            "parentSpanId": self.parent_id,
+            "name": self.name,
+            "startTimeUnixNano": int(self.start * 1e9),
+            "endTimeUnixNano": int((self.end or self.start) * 1e9),
+            "attributes": [
+                {"key": key, "value": {"stringValue": str(value)}}
+                for key, value in self.attrs.items()
+            ],
+        }
+
+
+class Trace:
+    def __init__(self, name: str, **attrs):
+        self.trace_id = os.urandom(16).hex()
+        self.root = Span(name, attrs=attrs)
+        self.spans: list[Span] = []
+
+    @property
+    def duration(self) -> float:
+        return (self.root.end or time.time()) - self.root.start
+
+    def start_span(self, name: str, **attrs) -> Span:
+        span = Span(name, self.root.span_id, attrs)
+        self.spans.append(span)
+        return span
+
+    def end_span(self, span: Span):
+        span.end = time.time()
+        tracer.export(self, span)
+
+    def add_span(self, name: str, start: float, end: float, **attrs):
+        """Record a span measured somewhere else (e.g. in a worker)."""
+        span = self.start_span(name, **attrs)
+        span.start = start
+        span.end = end
+        tracer.export(self, span)
+
+    def info(self) -> dict[str, Any]:
+        return {
+            "trace_id": self.trace_id,
+            "duration": self.duration,
+            "start": self.root.start,
+            **self.root.attrs,
+            "spans": [span.info(self.root.start) for span in self.spans],
+        }
+
+
+current_trace: ContextVar[Trace | None] = ContextVar("current_trace", default=None)
+
+
+@contextmanager
+def span(name: str, **attrs):
+    """
+    Record a phase of the current request, no-op outside of a traced request.
+    """
+    trace = current_trace.get()
+    if trace is None:
+        yield None
+        return
+    current = trace.start_span(name, **attrs)
+    try:
+        yield current
+    finally:
+        trace.end_span(current)
+
+
+class Tracer:
+    def __init__(self):
+        self.slow_threshold = 10.0
+        self.slow_requests: deque[Trace] = deque(maxlen=100)
+        self.export_path = ""
+        self.export_buffer: list[str] = []
+        self.export_batch = 64
+
+    def configure(self, slow_threshold: float, buffer_size: int, export_path: str):
+        self.slow_threshold = slow_threshold
+        self.slow_requests = deque(self.slow_requests, maxlen=buffer_size)
+        self.export_path = export_path
+
+    def finish(self, trace: Trace):
+        trace.root.end = time.time()
+        self.export(trace, trace.root)
+        # Requests without any phase (e.g. event streams) are not interesting
+        if trace.spans and trace.duration >= self.slow_threshold:
+            self.slow_requests.append(trace)
+
+    def export(self, trace: Trace, span: Span):
+        if not self.export_path:
+            return
+        self.export_buffer.append(json.dumps(span.otlp(trace.trace_id)))
+        if len(self.export_buffer) >= self.export_batch:
+            self.flush()
+
+    def flush(self):
+        if not self.export_buffer:
+            return
+        lines, self.export_buffer = self.export_buffer, []
+        try:
+            asyncio.get_running_loop().run_in_executor(
+                None, _append_lines, self.export_path, lines
+            )
+        except RuntimeError:
+            # No running loop (shutdown), write directly
+            _append_lines(self.export_path, lines)
+
+
+def _append_lines(path: str, lines: list[str]):
+    with open(path, "a", encoding="utf-8") as f:
+        f.write("\n".join(lines) + "\n")
+
+
+tracer = Tracer()
+
+
+class TracingMiddleware:
+    """
+    ASGI middleware which traces every http request and returns the trace id
+    in the X-Trace-Id header.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        trace = Trace("request", method=scope["method"], path=scope["path"])
+        token = current_trace.set(trace)
+
+        async def send_with_trace_id(message):
+            if message["type"] == "http.response.start":
+                trace.root.attrs["status"] = message["status"]
+                message["headers"] = [
+                    *message.get("headers", []),
+                    (b"x-trace-id", trace.trace_id.encode()),
+                ]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_trace_id)
+        finally:
+            current_trace.reset(token)
+            tracer.finish(trace)
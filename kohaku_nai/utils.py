@@ -2,10 +2,7 @@
 import re
 import io
 import json
-import piexif
-from typing import Any
-
-from PIL import Image
+from typing import TYPE_CHECKING, Any
 
 from . import api
 from .api.image import (
@@ -14,6 +11,10 @@ from .api.image import (
 )
 
 
+if TYPE_CHECKING:
+    from PIL import Image
+
+
 file_name_cleaner = re.compile(r"[^a-zA-Z0-9_.-]")
 
 
@@ -78,6 +79,8 @@ async def remote_gen(
     }
     response = await api.global_client.post(f"{end_point}/gen", json=payload)
     if response.status_code == 200:
+        from PIL import Image
+
         mem_file = io.BytesIO(response.content)
         mem_file.seek(0)
         return Image.open(mem_file), response.content
@@ -89,18 +92,21 @@ async def remote_gen(
         return None, data
 
 
-def free_check(width: int, height: int, steps: int):
-    return width * height <= 1024 * 1024 and steps <= 28
+def free_check(width: int, height: int, steps: int, n_samples: int = 1):
+    return width * height <= 1024 * 1024 and steps <= 28 and n_samples == 1
 
 
 def image_from_bytes(data: bytes):
+    # PIL is imported on first use, the server only needs it in encode workers
+    from PIL import Image
+
     img_file = io.BytesIO(data)
     img_file.seek(0)
     return Image.open(img_file)
 
 
 def process_image_as_webp(
-    image: Image,
+    image: "Image.Image",
     quality: int = 75,
     method: int = 4,
     metadata: dict[str, Any] = None,
@@ -120,6 +126,8 @@ def process_image_as_webp(
     Returns:
         bytes: the encoded image
     """
+    import piexif
+
     metadata_bytes: bytes | None = None
     if metadata:
         metadata_bytes = piexif.dump(metadata)